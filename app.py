@@ -6,28 +6,51 @@ Aplicación web para visualizar GPS de Geotab
 - Sincronización automática cada 5 minutos
 """
 import os
+import gzip
+import time
+import random
+import cProfile
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response, has_request_context, g
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
 import mygeotab
 import psycopg2.extras
 
 # Importar módulos propios
 from database import (
-    get_connection, get_db_cursor, init_database, get_estadisticas_por_fecha,
-    get_vehiculos_sin_reportar, get_resumen_por_placa_fecha
+    get_connection, get_db_cursor, get_estadisticas_por_fecha,
+    get_vehiculos_sin_reportar, get_resumen_por_placa_fecha, iterar_consulta,
+    get_ubicaciones_en_celdas, iterar_reportes_en_celdas
 )
-from sync_service import sync_service, iniciar_sync_automatica
+from sync_service import sync_service, iniciar_sync_automatica, LIMITE_VELOCIDAD
+from fleet_cache import FleetSnapshot
+from ignition_feed import IgnitionFeed
+from recorrido import agrupar_por_viaje, simplificar_viajes
+from geo_utils import (
+    tolerancia_por_zoom, IndiceGrilla, agrupar_en_clusters,
+    distancia_m, bbox_de_radio, geohashes_en_bbox
+)
+from compacto import dumps, compactar_recorrido, compactar_ubicaciones
+from metrics import (
+    medir_geotab, entidad_de, exportar_metricas, GEOTAB_REAUTENTICACIONES,
+    iniciar_fases, terminar_fases, registrar_fase
+)
+from device_index import device_index
+from historial import obtener_dia
+from exportar import EXPORTACIONES, consulta_exportacion, en_csv, en_ndjson
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 load_dotenv()
 
 app = Flask(__name__)
 COLOMBIA_TZ = ZoneInfo('America/Bogota')
 
-# Inicializar base de datos
-init_database()
-
 # Cliente de Geotab (singleton)
 _client = None
 
@@ -46,11 +69,17 @@ def get_client():
 def call_geotab(method, *args, **kwargs):
     """Llama a la API de Geotab y re-autentica si el token expiró."""
     global _client
+    # Métricas por ruta; los refrescos del snapshot corren sin request
+    origen = request.endpoint if has_request_context() else 'segundo_plano'
+    entidad = entidad_de(method, args, kwargs)
     try:
-        return getattr(get_client(), method)(*args, **kwargs)
+        return medir_geotab(origen, method, entidad,
+                            lambda: getattr(get_client(), method)(*args, **kwargs))
     except mygeotab.exceptions.AuthenticationException:
         _client = None  # fuerza re-autenticación
-        return getattr(get_client(), method)(*args, **kwargs)
+        GEOTAB_REAUTENTICACIONES.labels(origen).inc()
+        return medir_geotab(origen, method, entidad,
+                            lambda: getattr(get_client(), method)(*args, **kwargs))
 
 
 def to_colombia_iso(value):
@@ -69,12 +98,157 @@ def to_colombia_iso(value):
     return dt.astimezone(COLOMBIA_TZ).isoformat()
 
 
-def is_ignition_on(value):
-    if isinstance(value, bool):
-        return value
-    if isinstance(value, (int, float)):
-        return value == 1
-    return str(value).strip().lower() in ('1', 'true', 'on', 'yes', 'encendido')
+def call_geotab_multi(llamadas):
+    """Ejecuta varias llamadas [(método, params)] en un solo ExecuteMultiCall, con re-autenticación"""
+    return call_geotab('multi_call', llamadas)
+
+
+def consultar_dia_geotab(device_id, fecha_inicio, fecha_fin):
+    """Retorna una función que descarga de Geotab, en una sola petición, los tipos pedidos de un día"""
+    def consultar(tipos):
+        if not tipos:
+            return {}
+        llamadas = []
+        for tipo in tipos:
+            search = {'deviceSearch': {'id': device_id}, 'fromDate': fecha_inicio, 'toDate': fecha_fin}
+            if tipo == 'StatusData':
+                search['diagnosticSearch'] = {'id': 'DiagnosticIgnitionId'}
+            llamadas.append(('Get', {'typeName': tipo, 'search': search}))
+        try:
+            return dict(zip(tipos, call_geotab_multi(llamadas)))
+        except Exception:
+            if 'StatusData' not in tipos:
+                raise
+        # Ignición (DiagnosticIgnitionId) es opcional: si falla no se guarda y se reintenta el resto
+        return consultar([t for t in tipos if t != 'StatusData'])
+    return consultar
+
+
+def respuesta_json(datos):
+    """Respuesta JSON serializada con el codificador rápido (orjson si está disponible)"""
+    inicio = time.perf_counter()
+    cuerpo = dumps(datos)
+    registrar_fase('serializacion', time.perf_counter() - inicio)
+    return Response(cuerpo, mimetype='application/json')
+
+
+class ProveedorJSONMedido(DefaultJSONProvider):
+    """Proveedor JSON de Flask que registra el tiempo de jsonify como fase de serialización"""
+
+    def dumps(self, obj, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            registrar_fase('serializacion', time.perf_counter() - inicio)
+
+
+app.json = ProveedorJSONMedido(app)
+
+
+# ==================== SERVER-TIMING Y PERFILADO ====================
+
+# Server-Timing en todas las respuestas (si no, solo con el header X-Server-Timing: 1)
+SERVER_TIMING = os.getenv('SERVER_TIMING', '0') == '1'
+# Fracción de requests que se perfilan con cProfile (0 = ninguno)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+# Token para perfilar un request puntual con el header X-Profile (vacío = deshabilitado)
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'perfiles')
+
+
+@app.before_request
+def iniciar_medicion():
+    """Activa la medición por fases y el perfilado si el request lo pide o cae en el muestreo"""
+    medir = SERVER_TIMING or request.headers.get('X-Server-Timing') == '1'
+    perfilar = (random.random() < PROFILE_SAMPLE_RATE
+                or bool(PROFILE_TOKEN) and request.headers.get('X-Profile') == PROFILE_TOKEN)
+    if not (medir or perfilar):
+        return
+
+    g.server_timing = medir
+    g.inicio_request = time.perf_counter()
+    iniciar_fases()
+    if perfilar:
+        g.perfil = cProfile.Profile()
+        g.perfil.enable()
+
+
+def guardar_perfil(perfil):
+    """Escribe el perfil del request en PROFILE_DIR (abrir con pstats o snakeviz)"""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        nombre = f"{request.endpoint or 'desconocido'}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.prof"
+        ruta = os.path.join(PROFILE_DIR, nombre)
+        perfil.dump_stats(ruta)
+        print(f"🔬 Perfil guardado: {ruta}")
+    except OSError as e:
+        print(f"Error guardando perfil: {e}")
+
+
+@app.after_request
+def agregar_server_timing(response):
+    """Agrega Server-Timing (geotab, db, serialización, compresión, app, total)"""
+    inicio = g.pop('inicio_request', None)
+    if inicio is None:
+        return response
+
+    perfil = g.pop('perfil', None)
+    if perfil is not None:
+        perfil.disable()
+        guardar_perfil(perfil)
+
+    fases = terminar_fases()
+    if g.pop('server_timing', False):
+        total = time.perf_counter() - inicio
+        fases['app'] = max(0.0, total - sum(fases.values()))
+        fases['total'] = total
+        response.headers['Server-Timing'] = ', '.join(
+            f"{fase};dur={segundos * 1000:.1f}" for fase, segundos in fases.items()
+        )
+    return response
+
+
+@app.teardown_request
+def limpiar_medicion(error=None):
+    """Si el request falló antes de after_request, no dejar el perfilador activo en el hilo"""
+    perfil = g.pop('perfil', None)
+    if perfil is not None:
+        perfil.disable()
+    if g.pop('inicio_request', None) is not None:
+        terminar_fases()
+
+
+# Respuestas JSON más pequeñas que esto no se comprimen
+COMPRIMIR_MIN_BYTES = 1024
+
+
+@app.after_request
+def comprimir_respuesta(response):
+    """Comprime respuestas JSON con brotli o gzip según Accept-Encoding"""
+    if (response.is_streamed or response.direct_passthrough or response.status_code != 200
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    aceptadas = request.headers.get('Accept-Encoding', '').lower()
+    datos = response.get_data()
+    if len(datos) < COMPRIMIR_MIN_BYTES:
+        return response
+
+    inicio = time.perf_counter()
+    if brotli is not None and 'br' in aceptadas:
+        response.set_data(brotli.compress(datos, quality=4))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in aceptadas:
+        response.set_data(gzip.compress(datos, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    registrar_fase('compresion', time.perf_counter() - inicio)
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 
 @app.route('/')
@@ -83,6 +257,13 @@ def index():
     return render_template('index.html')
 
 
+@app.route('/metrics')
+def metricas():
+    """Métricas en formato Prometheus (llamadas a Geotab por ruta y fase de sync)"""
+    cuerpo, content_type = exportar_metricas()
+    return Response(cuerpo, content_type=content_type)
+
+
 @app.route('/estadisticas')
 def estadisticas():
     """Página de estadísticas"""
@@ -92,52 +273,33 @@ def estadisticas():
 @app.route('/api/dispositivos')
 def get_dispositivos():
     """Retorna lista de dispositivos (placas)"""
-    devices = call_geotab('get', 'Device')
-
-    resultado = [
-        {'id': d.get('id'), 'placa': d.get('name'), 'serial': d.get('serialNumber')}
-        for d in devices
-    ]
-    resultado.sort(key=lambda x: x['placa'] or '')
-    return jsonify(resultado)
+    return jsonify(device_index.dispositivos())
 
 
-@app.route('/api/ubicaciones')
-def get_ubicaciones():
-    """Retorna última ubicación de todos los dispositivos"""
-    # Obtener dispositivos con serial
-    devices = call_geotab('get', 'Device')
-    device_map = {d.get('id'): {'name': d.get('name'), 'serial': d.get('serialNumber', '')} for d in devices}
-
-    # Obtener estado actual de dispositivos (incluye ubicación)
-    status_info = call_geotab('get', 'DeviceStatusInfo')
+def construir_ubicaciones():
+    """Consulta Geotab y arma la última ubicación de todos los dispositivos"""
+    # Estado actual de dispositivos (incluye ubicación) y cambios de ignición en un solo ExecuteMultiCall
+    try:
+        status_info, pagina_feed = call_geotab_multi([
+            ('Get', {'typeName': 'DeviceStatusInfo'}),
+            ignition_feed.llamada()
+        ])
+    except Exception as e:
+        print(f"Error en ExecuteMultiCall de ubicaciones: {e}")
+        status_info, pagina_feed = call_geotab('get', 'DeviceStatusInfo'), None
 
-    ignition_by_device = {}
+    # Ignición: solo los cambios desde la última consulta (GetFeed)
     try:
-        ignition_data = call_geotab('get', 'StatusData',
-            diagnosticSearch={'id': 'DiagnosticIgnitionId'},
-            fromDate=datetime.now(timezone.utc) - timedelta(days=1),
-            toDate=datetime.now(timezone.utc)
-        )
-        for sd in ignition_data:
-            device_raw = sd.get('device', {})
-            sd_device_id = device_raw.get('id') if isinstance(device_raw, dict) else device_raw
-            dt = sd.get('dateTime')
-            if not sd_device_id or not dt:
-                continue
-            current = ignition_by_device.get(sd_device_id)
-            if current is None or dt > current['dateTime']:
-                ignition_by_device[sd_device_id] = {
-                    'dateTime': dt,
-                    'motor_encendido': is_ignition_on(sd.get('data'))
-                }
-    except Exception:
-        ignition_by_device = {}
+        if pagina_feed is None or ignition_feed.aplicar_pagina(pagina_feed):
+            ignition_feed.actualizar()
+    except Exception as e:
+        print(f"Error actualizando feed de ignición: {e}")
+    ignition_by_device = dict(ignition_feed.estado)
 
     ubicaciones = []
     for status in status_info:
         device_id = status.get('device', {}).get('id') if isinstance(status.get('device'), dict) else status.get('device')
-        device_info = device_map.get(device_id, {'name': 'Desconocido', 'serial': ''})
+        device_info = device_index.por_id(device_id) or {'placa': 'Desconocido', 'serial': ''}
 
         lat = status.get('latitude', 0)
         lng = status.get('longitude', 0)
@@ -150,7 +312,8 @@ def get_ubicaciones():
                 else (status.get('speed', 0) or 0) > 0
             )
             ubicaciones.append({
-                'placa': device_info['name'],
+                'id': device_id,
+                'placa': device_info['placa'],
                 'serial': device_info['serial'],
                 'lat': lat,
                 'lng': lng,
@@ -161,7 +324,141 @@ def get_ubicaciones():
                 'encendido': status.get('isDeviceCommunicating', False)
             })
 
-    return jsonify(ubicaciones)
+    return ubicaciones
+
+
+# Índice placa → dispositivo: la fuente remota es Geotab
+device_index.cargar_remoto = lambda: call_geotab('get', 'Device')
+
+# Estado de ignición incremental, alimentado por GetFeed
+ignition_feed = IgnitionFeed(call_geotab)
+
+# Un vehículo "cambió" si cambió su posición, la ignición o si está comunicando
+CAMPOS_CAMBIO = ('lat', 'lng', 'motor_encendido', 'encendido')
+
+# Snapshot compartido: N clientes del mapa = 1 consulta a Geotab por TTL
+# La clave es el id del dispositivo: varios pueden compartir placa (p. ej. 'Desconocido')
+fleet_snapshot = FleetSnapshot(
+    construir_ubicaciones,
+    clave=lambda v: v['id'],
+    cambio=lambda a, b: any(a.get(c) != b.get(c) for c in CAMPOS_CAMBIO)
+)
+
+# Segundos entre comentarios keep-alive del stream SSE
+SSE_KEEPALIVE = 15
+
+
+# Desde este zoom se envían marcadores individuales; en zooms menores, clusters del servidor
+ZOOM_MARCADORES = 12
+
+# Índice espacial del último snapshot: (snapshot, IndiceGrilla)
+_indice_ubicaciones = (None, None)
+
+
+def indice_ubicaciones(ubicaciones):
+    """Índice por grilla del snapshot; se reconstruye solo cuando el snapshot cambia"""
+    global _indice_ubicaciones
+    snapshot, indice = _indice_ubicaciones
+    if snapshot is not ubicaciones:
+        indice = IndiceGrilla(ubicaciones)
+        _indice_ubicaciones = (ubicaciones, indice)
+    return indice
+
+
+def ubicaciones_en_viewport(ubicaciones, bbox, zoom):
+    """Vehículos dentro del bbox; con zoom bajo se agrupan en clusters"""
+    visibles = indice_ubicaciones(ubicaciones).en_bbox(*bbox)
+    clusters = []
+    vehiculos = []
+    if zoom >= ZOOM_MARCADORES:
+        vehiculos = visibles
+    else:
+        for grupo in agrupar_en_clusters(visibles, zoom):
+            if len(grupo) == 1:
+                vehiculos.append(grupo[0])
+                continue
+            clusters.append({
+                'lat': sum(v['lat'] for v in grupo) / len(grupo),
+                'lng': sum(v['lng'] for v in grupo) / len(grupo),
+                'total': len(grupo),
+                'activos': sum(1 for v in grupo if v.get('encendido'))
+            })
+
+    return {
+        'bbox': list(bbox),
+        'zoom': zoom,
+        'total': len(visibles),
+        'clusters': clusters,
+        'vehiculos': vehiculos
+    }
+
+
+@app.route('/api/ubicaciones')
+def get_ubicaciones():
+    """
+    Retorna última ubicación de todos los dispositivos (desde el snapshot compartido).
+    Con ?desde=<cursor> (alias since) retorna solo los vehículos que cambiaron y un
+    cursor nuevo; desde=0 retorna la flota completa con su cursor.
+    Con ?bbox=sur,oeste,norte,este&zoom=z retorna solo lo visible, en clusters si el zoom es bajo.
+    """
+    compacto = request.args.get('formato') == 'compacto'
+    desde = request.args.get('desde', request.args.get('since'))
+    bbox = request.args.get('bbox')
+    try:
+        ubicaciones, cursor_snapshot = fleet_snapshot.obtener_con_cursor()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 503
+
+    if bbox:
+        try:
+            sur, oeste, norte, este = [float(x) for x in bbox.split(',')]
+        except ValueError:
+            return jsonify({'error': 'bbox debe ser sur,oeste,norte,este'}), 400
+        zoom = request.args.get('zoom', ZOOM_MARCADORES, type=int)
+        resultado = ubicaciones_en_viewport(ubicaciones, (sur, oeste, norte, este), zoom)
+        if compacto:
+            resultado['vehiculos'] = compactar_ubicaciones(resultado['vehiculos'])
+        response = respuesta_json(resultado)
+    elif desde is not None:
+        delta = fleet_snapshot.cambios_desde(desde)
+        if compacto:
+            delta['cambios'] = compactar_ubicaciones(delta['cambios'])
+        response = respuesta_json(delta)
+    elif compacto:
+        response = respuesta_json(compactar_ubicaciones(ubicaciones))
+    else:
+        response = respuesta_json(ubicaciones)
+    response.headers['Age'] = str(int(fleet_snapshot.edad() or 0))
+    # Versión de estos datos: el stream (o ?desde=) continúa desde aquí sin reenviar la flota
+    response.headers['X-Ubicaciones-Cursor'] = cursor_snapshot
+    return response
+
+
+@app.route('/api/ubicaciones/stream')
+def stream_ubicaciones():
+    """Server-Sent Events con los vehículos que cambian; se reanuda con Last-Event-ID"""
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('desde')
+    try:
+        fleet_snapshot.obtener()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 503
+
+    def eventos(cursor):
+        # Todas las conexiones comparten un único poller contra Geotab
+        with fleet_snapshot.suscripcion():
+            yield 'retry: 5000\n\n'
+            while True:
+                delta = fleet_snapshot.cambios_desde(cursor)
+                if delta['completo'] or delta['cambios'] or delta['eliminados']:
+                    yield f"id: {delta['cursor']}\nevent: ubicaciones\ndata: {dumps(delta).decode('utf-8')}\n\n"
+                cursor = delta['cursor']
+                if not fleet_snapshot.esperar_cambios(cursor, SSE_KEEPALIVE):
+                    yield ': ping\n\n'
+
+    return Response(eventos(cursor), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 
 @app.route('/api/viajes')
@@ -175,23 +472,17 @@ def get_viajes():
 
     try:
         # Buscar dispositivo por nombre (placa)
-        devices = call_geotab('get', 'Device', name=placa)
-        if not devices:
+        device_id = device_index.buscar_id(placa)
+        if not device_id:
             return jsonify({'error': 'Dispositivo no encontrado'}), 404
 
-        device = devices[0]
-        device_id = device.get('id')
-
         # Parsear fecha
         fecha_inicio = datetime.strptime(fecha, '%Y-%m-%d')
         fecha_fin = fecha_inicio + timedelta(days=1)
 
-        # Obtener viajes del día
-        trips = call_geotab('get', 'Trip',
-            deviceSearch={'id': device_id},
-            fromDate=fecha_inicio,
-            toDate=fecha_fin
-        )
+        # Obtener viajes del día (días cerrados desde el historial local)
+        trips = obtener_dia(device_id, fecha_inicio, ['Trip'],
+                            consultar_dia_geotab(device_id, fecha_inicio, fecha_fin))['Trip']
 
         viajes = []
         for i, trip in enumerate(trips):
@@ -241,118 +532,53 @@ def get_recorrido():
     """Retorna los puntos GPS del recorrido de un dispositivo en una fecha, agrupados por viaje"""
     placa = request.args.get('placa')
     fecha = request.args.get('fecha')  # formato: YYYY-MM-DD
+    # Simplificación opcional: tolerancia en metros, o zoom del mapa (1 pixel de tolerancia)
+    tolerancia = request.args.get('tolerancia', type=float)
+    if tolerancia is None:
+        tolerancia = request.args.get('tolerance', type=float)
+    zoom = request.args.get('zoom', type=int)
 
     if not placa or not fecha:
         return jsonify({'error': 'Se requiere placa y fecha'}), 400
 
     try:
         # Buscar dispositivo
-        devices = call_geotab('get', 'Device', name=placa)
-        if not devices:
+        device_id = device_index.buscar_id(placa)
+        if not device_id:
             return jsonify({'error': 'Dispositivo no encontrado'}), 404
 
-        device = devices[0]
-        device_id = device.get('id')
-
         # Parsear fecha
         fecha_inicio = datetime.strptime(fecha, '%Y-%m-%d')
         fecha_fin = fecha_inicio + timedelta(days=1)
 
-        # Obtener viajes del día para saber los rangos de tiempo
-        trips = call_geotab('get', 'Trip',
-            deviceSearch={'id': device_id},
-            fromDate=fecha_inicio,
-            toDate=fecha_fin
-        )
-
-        # Obtener registros GPS del día
-        log_records = call_geotab('get', 'LogRecord',
-            deviceSearch={'id': device_id},
-            fromDate=fecha_inicio,
-            toDate=fecha_fin
-        )
-
-        # Obtener datos de ignición (StatusData con DiagnosticIgnitionId)
-        try:
-            status_data = call_geotab('get', 'StatusData',
-                deviceSearch={'id': device_id},
-                diagnosticSearch={'id': 'DiagnosticIgnitionId'},
-                fromDate=fecha_inicio,
-                toDate=fecha_fin
-            )
-            # Crear diccionario de estados de ignición por tiempo aproximado
-            ignition_states = {}
-            for sd in status_data:
-                dt = sd.get('dateTime')
-                if dt:
-                    # data = 1 significa encendido, 0 apagado
-                    ignition_states[str(dt)] = sd.get('data', 0) == 1
-        except:
-            ignition_states = {}
-
-        # Ordenar registros por fecha
-        log_records.sort(key=lambda x: x.get('dateTime', ''))
+        # Viajes, registros GPS e ignición del día (días cerrados desde el historial local)
+        datos_dia = obtener_dia(device_id, fecha_inicio, ['Trip', 'LogRecord', 'StatusData'],
+                                consultar_dia_geotab(device_id, fecha_inicio, fecha_fin))
+        trips = datos_dia['Trip']
+        log_records = datos_dia['LogRecord']
+        status_data = datos_dia.get('StatusData', [])
 
         # Agrupar puntos por viaje
-        viajes_con_puntos = []
-        punto_global = 0  # Contador global de puntos
-
-        for i, trip in enumerate(trips):
-            trip_start = trip.get('start')
-            trip_stop = trip.get('stop')
+        viajes_con_puntos = agrupar_por_viaje(trips, log_records, status_data)
+        total_puntos_original = sum(v['total_puntos'] for v in viajes_con_puntos)
 
-            # Obtener coordenadas de fin del viaje
-            fin_lat = trip.get('stopLatitude', 0) or 0
-            fin_lng = trip.get('stopLongitude', 0) or 0
+        # Simplificación opcional del trazado
+        if tolerancia is None and zoom is not None:
+            tolerancia = tolerancia_por_zoom(zoom)
+        if tolerancia:
+            simplificar_viajes(viajes_con_puntos, tolerancia, LIMITE_VELOCIDAD)
 
-            puntos_viaje = []
-            for record in log_records:
-                record_time = record.get('dateTime')
-                if record_time and trip_start and trip_stop:
-                    if trip_start <= record_time <= trip_stop:
-                        lat = record.get('latitude', 0)
-                        lng = record.get('longitude', 0)
-                        velocidad = record.get('speed', 0) or 0
-                        if lat and lng and lat != 0 and lng != 0:
-                            punto_global += 1
-
-                            # Determinar estado de ignición
-                            # Buscar el estado de ignición más cercano
-                            ignicion = None
-                            for ign_time, ign_state in ignition_states.items():
-                                # Si hay un registro de ignición cercano, usarlo
-                                ignicion = ign_state
-
-                            # Si no hay datos de ignición, usar velocidad como indicador
-                            if ignicion is None:
-                                ignicion = velocidad > 0
-
-                            puntos_viaje.append({
-                                'num': punto_global,
-                                'lat': lat,
-                                'lng': lng,
-                                'velocidad': velocidad,
-                                'fecha': str(record_time),
-                                'ignicion': ignicion
-                            })
-
-            if puntos_viaje:
-                viajes_con_puntos.append({
-                    'viaje_num': i + 1,
-                    'inicio': str(trip_start),
-                    'fin': str(trip_stop),
-                    'fin_lat': fin_lat,
-                    'fin_lng': fin_lng,
-                    'puntos': puntos_viaje,
-                    'total_puntos': len(puntos_viaje)
-                })
-
-        return jsonify({
+        resultado = {
             'placa': placa,
             'fecha': fecha,
             'viajes': viajes_con_puntos,
-            'total_viajes': len(viajes_con_puntos)
-        })
+            'total_viajes': len(viajes_con_puntos),
+            'total_puntos_original': total_puntos_original,
+            'total_puntos': sum(v['total_puntos'] for v in viajes_con_puntos)
+        }
+        if request.args.get('formato') == 'compacto':
+            resultado = compactar_recorrido(resultado)
+        return respuesta_json(resultado)
 
     except Exception as e:
         print(f"Error en /api/recorrido: {e}")
@@ -424,52 +650,237 @@ def api_resumen_diario():
         return jsonify({'error': str(e)}), 500
 
 
+# Tamaño de página de /api/excesos
+EXCESOS_LIMITE = 100
+EXCESOS_LIMITE_MAX = 1000
+
+
+def cursor_exceso(fila):
+    """Cursor de paginación '<fecha_gps ISO>_<id>' de la última fila de una página"""
+    return f"{fila['fecha_gps'].isoformat()}_{fila['id']}"
+
+
+def leer_cursor_exceso(cursor):
+    """(fecha_gps, id) de un cursor de /api/excesos; ValueError si es inválido"""
+    fecha_gps, id_exceso = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(fecha_gps), int(id_exceso)
+
+
 @app.route('/api/excesos')
 def api_excesos():
-    """Retorna excesos de velocidad por rango de fechas"""
+    """Retorna excesos de velocidad por rango de fechas, paginados por (fecha_gps, id)"""
     fecha_inicio = request.args.get('fecha_inicio')
     fecha_fin = request.args.get('fecha_fin')
     placa = request.args.get('placa')
+    limite = min(max(request.args.get('limite', EXCESOS_LIMITE, type=int), 1), EXCESOS_LIMITE_MAX)
+    cursor_pagina = request.args.get('cursor')
 
     if not fecha_inicio:
         fecha_inicio = datetime.now().strftime('%Y-%m-%d')
     if not fecha_fin:
         fecha_fin = fecha_inicio
 
+    try:
+        despues_de = leer_cursor_exceso(cursor_pagina) if cursor_pagina else None
+        inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d')
+        fin = datetime.strptime(fecha_fin, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Parámetros de fecha o cursor inválidos'}), 400
+
+    # `fecha` es el día en hora Colombia; el rango holgado sobre fecha_gps deja usar
+    # el índice (fecha_gps, id) y el filtro exacto sigue siendo `fecha`.
+    # Las filas sin fecha_gps no se pueden paginar por cursor y quedan fuera
+    condiciones = ['fecha BETWEEN %s AND %s', 'fecha_gps IS NOT NULL', 'fecha_gps >= %s', 'fecha_gps < %s']
+    params = [fecha_inicio, fecha_fin, inicio - timedelta(days=1), fin + timedelta(days=2)]
+    if placa:
+        condiciones.append('placa = %s')
+        params.append(placa)
+    if despues_de:
+        condiciones.append('(fecha_gps, id) < (%s, %s)')
+        params.extend(despues_de)
+
     try:
         with get_db_cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-            if placa:
-                cursor.execute('''
-                    SELECT * FROM excesos_velocidad
-                    WHERE fecha BETWEEN %s AND %s AND placa = %s
-                    ORDER BY fecha_gps DESC
-                ''', (fecha_inicio, fecha_fin, placa))
-            else:
+            cursor.execute(f'''
+                SELECT * FROM excesos_velocidad
+                WHERE {' AND '.join(condiciones)}
+                ORDER BY fecha_gps DESC, id DESC
+                LIMIT %s
+            ''', params + [limite + 1])
+
+            excesos = [dict(row) for row in cursor.fetchall()]
+            hay_mas = len(excesos) > limite
+            excesos = excesos[:limite]
+
+            respuesta = {
+                'fecha_inicio': fecha_inicio,
+                'fecha_fin': fecha_fin,
+                'limite': limite,
+                'excesos': excesos,
+                'siguiente': cursor_exceso(excesos[-1]) if hay_mas else None
+            }
+
+            # Conteo y resumen por placa solo en la primera página
+            if not despues_de:
                 cursor.execute('''
-                    SELECT * FROM excesos_velocidad
-                    WHERE fecha BETWEEN %s AND %s
-                    ORDER BY fecha_gps DESC
+                    SELECT placa, COUNT(*) as total, MAX(velocidad) as velocidad_max
+                    FROM excesos_velocidad
+                    WHERE fecha BETWEEN %s AND %s AND fecha_gps IS NOT NULL
+                    GROUP BY placa
+                    ORDER BY total DESC
                 ''', (fecha_inicio, fecha_fin))
 
-            excesos = [dict(row) for row in cursor.fetchall()]
+                resumen = [dict(row) for row in cursor.fetchall()]
+                respuesta['resumen_por_placa'] = resumen
+                respuesta['total'] = sum(r['total'] for r in resumen if not placa or r['placa'] == placa)
+
+        return jsonify(respuesta)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-            # Agrupar por placa
-            cursor.execute('''
-                SELECT placa, COUNT(*) as total, MAX(velocidad) as velocidad_max
-                FROM excesos_velocidad
-                WHERE fecha BETWEEN %s AND %s
-                GROUP BY placa
-                ORDER BY total DESC
-            ''', (fecha_inicio, fecha_fin))
 
-            resumen = [dict(row) for row in cursor.fetchall()]
+@app.route('/api/exportar/<tipo>')
+def api_exportar(tipo):
+    """Exporta viajes, excesos o resumen diario en CSV o NDJSON, en streaming"""
+    if tipo not in EXPORTACIONES:
+        return jsonify({'error': f"Tipo de exportación desconocido: {tipo}"}), 404
+
+    formato = request.args.get('formato', 'csv')
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({'error': 'formato debe ser csv o ndjson'}), 400
+
+    fecha_inicio = request.args.get('fecha_inicio') or datetime.now().strftime('%Y-%m-%d')
+    fecha_fin = request.args.get('fecha_fin') or fecha_inicio
+    placa = request.args.get('placa')
+    try:
+        datetime.strptime(fecha_inicio, '%Y-%m-%d')
+        datetime.strptime(fecha_fin, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Formato de fecha inválido. Use YYYY-MM-DD'}), 400
+
+    consulta, params, columnas = consulta_exportacion(tipo, fecha_inicio, fecha_fin, placa)
+    filas = iterar_consulta(consulta, params, nombre=f'exportar_{tipo}')
+    if formato == 'csv':
+        cuerpo, mimetype = en_csv(columnas, filas), 'text/csv'
+    else:
+        cuerpo, mimetype = en_ndjson(filas), 'application/x-ndjson'
+
+    nombre = f"{tipo}_{fecha_inicio}_{fecha_fin}{'_' + placa if placa else ''}.{formato}"
+    return Response(cuerpo, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{nombre}"',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+# Radio por defecto y máximo (metros) de las búsquedas espaciales
+RADIO_CERCANOS_M = 2000
+RADIO_MAX_M = 50000
+# Días máximos de /api/paso_por_zona
+PASO_ZONA_MAX_DIAS = 31
+
+
+@app.route('/api/cercanos')
+def api_cercanos():
+    """Vehículos cuya última ubicación está a menos de `radio` metros de un punto"""
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radio = min(request.args.get('radio', RADIO_CERCANOS_M, type=float), RADIO_MAX_M)
+    limite = request.args.get('limite', 20, type=int)
+
+    if lat is None or lng is None:
+        return jsonify({'error': 'Se requieren lat y lng'}), 400
+    if radio <= 0:
+        return jsonify({'error': 'radio debe ser mayor que 0'}), 400
+
+    try:
+        # Rango por celdas de geohash en el índice y luego distancia exacta
+        prefijos = geohashes_en_bbox(*bbox_de_radio(lat, lng, radio))
+        cercanos = []
+        for u in get_ubicaciones_en_celdas(prefijos):
+            distancia = distancia_m(lat, lng, u['latitud'], u['longitud'])
+            if distancia <= radio:
+                u['distancia_m'] = round(distancia)
+                cercanos.append(u)
+        cercanos.sort(key=lambda u: u['distancia_m'])
+
+        return jsonify({
+            'lat': lat,
+            'lng': lng,
+            'radio': radio,
+            'total': len(cercanos),
+            'vehiculos': cercanos[:limite]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/paso_por_zona')
+def api_paso_por_zona():
+    """
+    Vehículos con puntos GPS dentro de una zona en un rango de fechas (por defecto ayer).
+    Zona: lat, lng y radio (metros) o bbox=sur,oeste,norte,este.
+    """
+    ayer = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    fecha_inicio = request.args.get('fecha_inicio') or request.args.get('fecha') or ayer
+    fecha_fin = request.args.get('fecha_fin') or fecha_inicio
+    try:
+        dias = (datetime.strptime(fecha_fin, '%Y-%m-%d') - datetime.strptime(fecha_inicio, '%Y-%m-%d')).days
+    except ValueError:
+        return jsonify({'error': 'Formato de fecha inválido. Use YYYY-MM-DD'}), 400
+    if dias < 0 or dias >= PASO_ZONA_MAX_DIAS:
+        return jsonify({'error': f'El rango debe ser de 1 a {PASO_ZONA_MAX_DIAS} días'}), 400
+
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    bbox = request.args.get('bbox')
+    if bbox:
+        try:
+            sur, oeste, norte, este = (float(v) for v in bbox.split(','))
+        except ValueError:
+            return jsonify({'error': 'bbox debe ser sur,oeste,norte,este'}), 400
+        if sur > norte or oeste > este:
+            return jsonify({'error': 'bbox inválido: se requiere sur <= norte y oeste <= este'}), 400
+        zona = {'bbox': [sur, oeste, norte, este]}
+        dentro = lambda la, ln: sur <= la <= norte and oeste <= ln <= este
+    elif lat is not None and lng is not None:
+        radio = min(request.args.get('radio', RADIO_CERCANOS_M, type=float), RADIO_MAX_M)
+        if radio <= 0:
+            return jsonify({'error': 'radio debe ser mayor que 0'}), 400
+        sur, oeste, norte, este = bbox_de_radio(lat, lng, radio)
+        zona = {'lat': lat, 'lng': lng, 'radio': radio}
+        dentro = lambda la, ln: distancia_m(lat, lng, la, ln) <= radio
+    else:
+        return jsonify({'error': 'Se requiere lat y lng (con radio) o bbox'}), 400
+
+    try:
+        prefijos = geohashes_en_bbox(sur, oeste, norte, este)
+        por_placa = {}
+        for p in iterar_reportes_en_celdas(prefijos, fecha_inicio, fecha_fin):
+            if p['latitud'] is None or p['fecha_gps'] is None or not dentro(p['latitud'], p['longitud']):
+                continue
+            v = por_placa.get(p['placa'])
+            if v is None:
+                por_placa[p['placa']] = {
+                    'placa': p['placa'], 'primer_paso': p['fecha_gps'], 'ultimo_paso': p['fecha_gps'],
+                    'puntos': 1, 'velocidad_max': p['velocidad'] or 0
+                }
+                continue
+            v['primer_paso'] = min(v['primer_paso'], p['fecha_gps'])
+            v['ultimo_paso'] = max(v['ultimo_paso'], p['fecha_gps'])
+            v['puntos'] += 1
+            v['velocidad_max'] = max(v['velocidad_max'], p['velocidad'] or 0)
+
+        vehiculos = sorted(por_placa.values(), key=lambda v: v['primer_paso'])
+        for v in vehiculos:
+            v['primer_paso'] = to_colombia_iso(v['primer_paso'])
+            v['ultimo_paso'] = to_colombia_iso(v['ultimo_paso'])
 
         return jsonify({
             'fecha_inicio': fecha_inicio,
             'fecha_fin': fecha_fin,
-            'total': len(excesos),
-            'excesos': excesos[:100],
-            'resumen_por_placa': resumen
+            'zona': zona,
+            'total': len(vehiculos),
+            'vehiculos': vehiculos
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -509,11 +920,11 @@ def api_historial_km():
                     ORDER BY fecha
                 ''', (placa, fecha_inicio))
             else:
+                # Totales de la flota por día ya agregados (se actualizan junto con resumen_diario)
                 cursor.execute('''
-                    SELECT fecha, SUM(total_km) as total_km, SUM(total_viajes) as total_viajes, SUM(total_excesos) as total_excesos
-                    FROM resumen_diario
+                    SELECT fecha, total_km, total_viajes, total_excesos
+                    FROM resumen_flota_dia
                     WHERE fecha >= %s
-                    GROUP BY fecha
                     ORDER BY fecha
                 ''', (fecha_inicio,))
 
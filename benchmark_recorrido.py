@@ -0,0 +1,99 @@
+"""
+Benchmark del armado de /api/recorrido con un día sintético de 50.000 puntos
+Compara el algoritmo anterior (cada viaje recorre todos los puntos) con el
+particionado por búsqueda binaria de recorrido.agrupar_por_viaje
+
+Uso: python benchmark_recorrido.py [puntos] [viajes]
+"""
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+from recorrido import agrupar_por_viaje
+
+
+def agrupar_por_viaje_anterior(trips, log_records, status_data):
+    """Algoritmo original de get_recorrido: O(viajes × puntos) y O(puntos × ignición)"""
+    ignition_states = {}
+    for sd in status_data:
+        dt = sd.get('dateTime')
+        if dt:
+            ignition_states[str(dt)] = sd.get('data', 0) == 1
+
+    log_records.sort(key=lambda x: x.get('dateTime', ''))
+
+    viajes_con_puntos = []
+    punto_global = 0
+    for i, trip in enumerate(trips):
+        trip_start = trip.get('start')
+        trip_stop = trip.get('stop')
+        puntos_viaje = []
+        for record in log_records:
+            record_time = record.get('dateTime')
+            if record_time and trip_start and trip_stop:
+                if trip_start <= record_time <= trip_stop:
+                    lat = record.get('latitude', 0)
+                    lng = record.get('longitude', 0)
+                    velocidad = record.get('speed', 0) or 0
+                    if lat and lng and lat != 0 and lng != 0:
+                        punto_global += 1
+                        ignicion = None
+                        for ign_time, ign_state in ignition_states.items():
+                            ignicion = ign_state
+                        if ignicion is None:
+                            ignicion = velocidad > 0
+                        puntos_viaje.append({
+                            'num': punto_global, 'lat': lat, 'lng': lng,
+                            'velocidad': velocidad, 'fecha': str(record_time),
+                            'ignicion': ignicion
+                        })
+        if puntos_viaje:
+            viajes_con_puntos.append({'viaje_num': i + 1, 'puntos': puntos_viaje})
+    return viajes_con_puntos
+
+
+def generar_dia(n_puntos, n_viajes, semilla=42):
+    """Genera viajes, LogRecord y StatusData de ignición para un día"""
+    rnd = random.Random(semilla)
+    inicio_dia = datetime(2024, 3, 1)
+    paso = timedelta(seconds=86400 / n_puntos)
+    log_records = [{
+        'dateTime': inicio_dia + paso * i,
+        'latitude': 4.6 + rnd.uniform(-0.1, 0.1),
+        'longitude': -74.08 + rnd.uniform(-0.1, 0.1),
+        'speed': rnd.randint(0, 110)
+    } for i in range(n_puntos)]
+    rnd.shuffle(log_records)
+
+    bloque = timedelta(days=1) / n_viajes
+    trips = []
+    status_data = []
+    for v in range(n_viajes):
+        start = inicio_dia + bloque * v
+        stop = start + bloque * 0.8
+        trips.append({'start': start, 'stop': stop, 'stopLatitude': 4.6, 'stopLongitude': -74.08})
+        status_data.append({'dateTime': start, 'data': 1})
+        status_data.append({'dateTime': stop, 'data': 0})
+    return trips, log_records, status_data
+
+
+def medir(nombre, funcion, trips, log_records, status_data):
+    t0 = time.perf_counter()
+    resultado = funcion(trips, list(log_records), status_data)
+    segundos = time.perf_counter() - t0
+    puntos = sum(len(v['puntos']) for v in resultado)
+    print(f"{nombre:<12} {segundos * 1000:>10.1f} ms  ({len(resultado)} viajes, {puntos} puntos)")
+    return segundos
+
+
+if __name__ == '__main__':
+    n_puntos = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    n_viajes = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+    trips, log_records, status_data = generar_dia(n_puntos, n_viajes)
+    print(f"Día sintético: {n_puntos} puntos, {n_viajes} viajes, {len(status_data)} registros de ignición\n")
+
+    t_anterior = medir('anterior', agrupar_por_viaje_anterior, trips, log_records, status_data)
+    t_nuevo = medir('particionado', agrupar_por_viaje, trips, log_records, status_data)
+    print(f"\nAceleración: {t_anterior / t_nuevo:.1f}x")
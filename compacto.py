@@ -0,0 +1,85 @@
+"""
+Formato compacto para /api/recorrido y /api/ubicaciones (?formato=compacto)
+- Recorrido: polyline codificada de Google + columnas con deltas de tiempo
+- Ubicaciones: columnas en lugar de un objeto por vehículo
+- Serialización con orjson si está instalado
+"""
+import json
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PRECISION_POLYLINE = 5
+
+
+def dumps(datos):
+    """Serializa a bytes JSON con el codificador más rápido disponible"""
+    if orjson is not None:
+        return orjson.dumps(datos, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(datos, default=str, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _codificar_valor(valor, salida):
+    valor = ~(valor << 1) if valor < 0 else valor << 1
+    while valor >= 0x20:
+        salida.append(chr((0x20 | (valor & 0x1f)) + 63))
+        valor >>= 5
+    salida.append(chr(valor + 63))
+
+
+def codificar_polyline(coordenadas, precision=PRECISION_POLYLINE):
+    """Codifica [(lat, lng), ...] con el algoritmo de polylines de Google"""
+    factor = 10 ** precision
+    salida = []
+    prev_lat = prev_lng = 0
+    for lat, lng in coordenadas:
+        ilat = int(round(lat * factor))
+        ilng = int(round(lng * factor))
+        _codificar_valor(ilat - prev_lat, salida)
+        _codificar_valor(ilng - prev_lng, salida)
+        prev_lat, prev_lng = ilat, ilng
+    return ''.join(salida)
+
+
+def _deltas(valores):
+    previo = 0
+    resultado = []
+    for v in valores:
+        resultado.append(v - previo)
+        previo = v
+    return resultado
+
+
+def compactar_recorrido(respuesta):
+    """Convierte la respuesta de /api/recorrido a columnas por viaje"""
+    viajes = []
+    for viaje in respuesta['viajes']:
+        puntos = viaje['puntos']
+        tiempos = [int(datetime.fromisoformat(p['fecha']).timestamp()) for p in puntos]
+        compacto = {k: v for k, v in viaje.items() if k != 'puntos'}
+        compacto.update({
+            'polyline': codificar_polyline([(p['lat'], p['lng']) for p in puntos]),
+            'num': _deltas([p['num'] for p in puntos]),
+            'tiempo': _deltas(tiempos),  # segundos epoch, delta respecto al anterior
+            'velocidad': [p['velocidad'] for p in puntos],
+            'ignicion': [1 if p['ignicion'] else 0 for p in puntos],
+        })
+        viajes.append(compacto)
+
+    resultado = {k: v for k, v in respuesta.items() if k != 'viajes'}
+    resultado.update({'formato': 'compacto', 'precision': PRECISION_POLYLINE, 'viajes': viajes})
+    return resultado
+
+
+def compactar_ubicaciones(ubicaciones, campos=None):
+    """Convierte la lista de ubicaciones a {'formato', 'total', 'columnas': {campo: [...]}}"""
+    if campos is None:
+        campos = list(ubicaciones[0].keys()) if ubicaciones else []
+    return {
+        'formato': 'compacto',
+        'total': len(ubicaciones),
+        'columnas': {c: [u.get(c) for u in ubicaciones] for c in campos}
+    }
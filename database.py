@@ -1,13 +1,24 @@
 """
 Módulo de base de datos para GPS Geotab - PostgreSQL
 """
+import csv
+import io
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 import os
+import re
+import threading
+import time
+from functools import lru_cache
 from dotenv import load_dotenv
 
+from metrics import registrar_fase, DB_CONSULTAS, DB_FILAS, DB_CONSULTAS_LENTAS
+from geo_utils import codificar_geohash
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -21,47 +32,501 @@ DB_CONFIG = {
 }
 
 
+# Pool de conexiones compartido por las rutas Flask y SyncService.
+# DB_POOL_MIN son las conexiones que se mantienen abiertas en reposo; las que pasen de ahí
+# (hasta DB_POOL_MAX) se cierran al devolverse
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '4'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+# Segundos que se espera una conexión libre antes de fallar
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+# Una conexión ociosa más tiempo que esto se verifica con SELECT 1 antes de usarla
+DB_POOL_PING_SEGUNDOS = float(os.getenv('DB_POOL_PING_SEGUNDOS', '60'))
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_disponibles = threading.BoundedSemaphore(DB_POOL_MAX)
+_ultimo_uso = {}  # id(conexión) -> time.monotonic() de la última devolución
+
+
 def get_connection():
     """Obtiene conexión a la base de datos PostgreSQL"""
     conn = psycopg2.connect(**DB_CONFIG)
     return conn
 
 
+def get_pool():
+    """Pool de conexiones (se crea en el primer uso)"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **DB_CONFIG)
+    return _pool
+
+
+def _conexion_sana(conn):
+    """Descarta conexiones cerradas y verifica las que llevan mucho tiempo ociosas"""
+    if conn.closed:
+        return False
+    if time.monotonic() - _ultimo_uso.get(id(conn), 0) < DB_POOL_PING_SEGUNDOS:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+
+def _tomar_conexion():
+    pool = get_pool()
+    # ThreadedConnectionPool falla si está agotado; el semáforo hace esperar en su lugar
+    if not _pool_disponibles.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError(f"Sin conexiones libres en el pool tras {DB_POOL_TIMEOUT}s")
+    try:
+        for _ in range(DB_POOL_MAX + 1):
+            conn = pool.getconn()
+            if _conexion_sana(conn):
+                return conn
+            _ultimo_uso.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("No se pudo obtener una conexión sana del pool")
+    except Exception:
+        _pool_disponibles.release()
+        raise
+
+
+def _devolver_conexion(conn):
+    try:
+        if not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    try:
+        if conn.closed:
+            _ultimo_uso.pop(id(conn), None)
+            get_pool().putconn(conn, close=True)
+        else:
+            _ultimo_uso[id(conn)] = time.monotonic()
+            get_pool().putconn(conn)
+            if conn.closed:
+                _ultimo_uso.pop(id(conn), None)
+    finally:
+        _pool_disponibles.release()
+
+
 @contextmanager
 def get_db_connection():
-    """Context manager para conexiones seguras - SIEMPRE cierra la conexión"""
-    conn = None
+    """Context manager que toma una conexión del pool y SIEMPRE la devuelve"""
+    if not _esquema_listo:
+        init_database()
+    conn = _tomar_conexion()
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
         yield conn
     finally:
-        if conn:
-            conn.close()
+        _devolver_conexion(conn)
+
+
+def cerrar_pool():
+    """Cierra todas las conexiones del pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _ultimo_uso.clear()
+
+
+# ==================== INSTRUMENTACIÓN DE CONSULTAS ====================
+
+# Sentencias más lentas que esto se registran en consultas_lentas con su plan
+DB_CONSULTA_LENTA_MS = float(os.getenv('DB_CONSULTA_LENTA_MS', '500'))
+# Segundos mínimos entre dos EXPLAIN de la misma huella
+DB_EXPLAIN_INTERVALO = float(os.getenv('DB_EXPLAIN_INTERVALO', '600'))
+# Tiempo máximo de un EXPLAIN ANALYZE (se vuelve a ejecutar la consulta)
+DB_EXPLAIN_TIMEOUT_MS = int(os.getenv('DB_EXPLAIN_TIMEOUT_MS', '30000'))
+
+_ultimo_explain = {}  # huella -> time.monotonic()
+_explain_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1024)
+def huella_consulta(sql):
+    """Huella legible y estable de una sentencia: sin literales, espacios ni listas VALUES"""
+    texto = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    texto = re.sub(r'\b\d+(?:\.\d+)?\b', '?', texto)
+    texto = ' '.join(texto.split())
+    valores = re.search(r'\bVALUES\b', texto, re.IGNORECASE)
+    if valores:
+        texto = texto[:valores.end()] + ' ...'
+    return texto[:120]
+
+
+def _texto_sql(consulta):
+    if isinstance(consulta, bytes):
+        return consulta[:1000].decode('utf-8', 'replace')
+    return str(consulta)[:1000]
+
+
+def _es_solo_lectura(sql):
+    """EXPLAIN ANALYZE ejecuta la sentencia: solo se captura para SELECT"""
+    inicio = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    if inicio == 'SELECT':
+        return True
+    return inicio == 'WITH' and not re.search(r'\b(INSERT|UPDATE|DELETE)\b', sql, re.IGNORECASE)
+
+
+def _capturar_plan(huella, sql_completo, duracion_ms, filas):
+    """Guarda en consultas_lentas el plan de una sentencia lenta (en un hilo aparte)"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            plan = None
+            if _es_solo_lectura(sql_completo):
+                cursor.execute('SET LOCAL statement_timeout = %s', (DB_EXPLAIN_TIMEOUT_MS,))
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql_completo)
+                plan = '\n'.join(fila[0] for fila in cursor.fetchall())
+                conn.rollback()
+            cursor.execute('''
+                INSERT INTO consultas_lentas (huella, consulta, duracion_ms, filas, plan)
+                VALUES (%s, %s, %s, %s, %s)
+            ''', (huella, sql_completo[:20000], duracion_ms, filas, plan))
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        print(f"Error capturando plan de consulta lenta: {e}")
+
+
+class CursorMedido:
+    """Envuelve un cursor de psycopg2 midiendo cada sentencia (latencia y filas por huella)"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _medir(self, consulta, params, ejecutar):
+        huella = huella_consulta(_texto_sql(consulta))
+        inicio = time.perf_counter()
+        try:
+            return ejecutar()
+        finally:
+            duracion = time.perf_counter() - inicio
+            filas = max(self._cursor.rowcount, 0)
+            DB_CONSULTAS.labels(huella).observe(duracion)
+            DB_FILAS.labels(huella).inc(filas)
+            if duracion * 1000 >= DB_CONSULTA_LENTA_MS:
+                self._consulta_lenta(huella, consulta, params, duracion * 1000, filas)
+
+    def _consulta_lenta(self, huella, consulta, params, duracion_ms, filas):
+        DB_CONSULTAS_LENTAS.labels(huella).inc()
+        print(f"🐢 Consulta lenta ({duracion_ms:.0f} ms, {filas} filas): {huella}")
+        ahora = time.monotonic()
+        with _explain_lock:
+            if ahora - _ultimo_explain.get(huella, -DB_EXPLAIN_INTERVALO) < DB_EXPLAIN_INTERVALO:
+                return
+            _ultimo_explain[huella] = ahora
+        try:
+            sql = self._cursor.mogrify(consulta, params) if params is not None else consulta
+            sql = sql.decode('utf-8', 'replace') if isinstance(sql, bytes) else sql
+        except Exception:
+            return
+        threading.Thread(target=_capturar_plan, args=(huella, sql, duracion_ms, filas), daemon=True).start()
+
+    def execute(self, consulta, params=None):
+        return self._medir(consulta, params, lambda: self._cursor.execute(consulta, params))
+
+    def executemany(self, consulta, lista_params):
+        return self._medir(consulta, None, lambda: self._cursor.executemany(consulta, lista_params))
+
+    def copy_expert(self, consulta, archivo, *args, **kwargs):
+        return self._medir(consulta, None, lambda: self._cursor.copy_expert(consulta, archivo, *args, **kwargs))
 
 
 @contextmanager
 def get_db_cursor(cursor_factory=None):
     """Context manager para cursor con commit automático"""
+    inicio = time.perf_counter()
     with get_db_connection() as conn:
         cursor = conn.cursor(cursor_factory=cursor_factory) if cursor_factory else conn.cursor()
         try:
-            yield cursor
+            yield CursorMedido(cursor)
             conn.commit()
         except Exception:
             conn.rollback()
             raise
         finally:
             cursor.close()
+            registrar_fase('db', time.perf_counter() - inicio)
 
 
-def init_database():
-    """Inicializa la base de datos con todas las tablas necesarias"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    if True:
+def iterar_consulta(consulta, params=(), nombre='exportacion', tamano_lote=2000):
+    """Recorre una consulta grande con un cursor con nombre (del lado del servidor), en lotes"""
+    with get_db_connection() as conn:
+        with conn.cursor(name=nombre, cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.itersize = tamano_lote
+            cursor.execute(consulta, params)
+            yield from cursor
+        conn.rollback()
+
+
+# (índice, tabla, columnas) de las claves naturales usadas por ON CONFLICT.
+# fecha va en las claves de reportes y excesos para que sirvan también con tablas particionadas por fecha
+CLAVES_UNICAS = (
+    ('idx_ubicaciones_placa_unica', 'ubicaciones', ('placa',)),
+    ('idx_viajes_clave', 'viajes', ('placa', 'fecha', 'viaje_num')),
+    ('idx_reportes_clave', 'reportes_gps', ('dispositivo_id', 'fecha', 'fecha_gps')),
+    ('idx_excesos_clave', 'excesos_velocidad', ('dispositivo_id', 'fecha', 'fecha_gps')),
+)
+
+# Filas por sentencia en los INSERT en lote
+LOTE_INSERT = 1000
+
+
+def crear_indice_unico(cursor, nombre, tabla, columnas):
+    """Crea un índice único eliminando antes los duplicados existentes (se conserva el id mayor)"""
+    cursor.execute('SELECT to_regclass(%s)', (nombre,))
+    if cursor.fetchone()[0] is not None:
+        return
+    cols = ', '.join(columnas)
+    no_nulas = ' AND '.join(f'{c} IS NOT NULL' for c in columnas)
+    cursor.execute(f'''
+        DELETE FROM {tabla} WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY {cols} ORDER BY id DESC) as n
+                FROM {tabla} WHERE {no_nulas}
+            ) repetidos WHERE n > 1
+        )
+    ''')
+    if cursor.rowcount:
+        print(f"Eliminados {cursor.rowcount} duplicados de {tabla}")
+    cursor.execute(f'CREATE UNIQUE INDEX {nombre} ON {tabla} ({cols})')
+
+
+def _reasignar_ubicaciones_por_id(cursor):
+    """Pasa a la placa real las filas de ubicaciones que guardaban el id del dispositivo como placa"""
+    # Antes de la escritura por placa, sync_ubicaciones usaba el id de Geotab como placa;
+    # sin esto esas filas quedan congeladas y aparecen como vehículos fantasma
+    cursor.execute('''
+        UPDATE ubicaciones u SET placa = d.placa
+        FROM dispositivos d
+        WHERE u.dispositivo_id = d.id AND u.placa = d.id
+          AND d.placa IS NOT NULL AND d.placa <> d.id
+          AND NOT EXISTS (SELECT 1 FROM ubicaciones o WHERE o.placa = d.placa)
+    ''')
+    actualizadas = cursor.rowcount
+    # Las que ya tienen una fila con la placa real sobran
+    cursor.execute('''
+        DELETE FROM ubicaciones u
+        USING dispositivos d
+        WHERE u.dispositivo_id = d.id AND u.placa = d.id
+          AND d.placa IS NOT NULL AND d.placa <> d.id
+    ''')
+    if actualizadas or cursor.rowcount:
+        print(f"  ubicaciones por id: {actualizadas} pasadas a placa, {cursor.rowcount} eliminadas")
 
-        # Tabla de dispositivos/vehículos
+
+# ==================== TABLAS PARTICIONADAS POR MES ====================
+
+# tabla -> (columnas sin id, columna de tiempo para el índice BRIN).
+# La llave primaria incluye fecha porque PostgreSQL exige la clave de partición en los índices únicos
+TABLAS_PARTICIONADAS = {
+    'viajes': ('''
+        dispositivo_id TEXT,
+        placa TEXT,
+        fecha DATE,
+        viaje_num INTEGER,
+        hora_inicio TIMESTAMP,
+        hora_fin TIMESTAMP,
+        distancia_km REAL,
+        duracion_min REAL,
+        velocidad_max REAL,
+        lat_inicio REAL,
+        lng_inicio REAL,
+        lat_fin REAL,
+        lng_fin REAL,
+        fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (dispositivo_id) REFERENCES dispositivos(id)
+    ''', 'hora_inicio'),
+    'reportes_gps': ('''
+        dispositivo_id TEXT,
+        placa TEXT,
+        fecha DATE,
+        latitud REAL,
+        longitud REAL,
+        velocidad REAL,
+        fecha_gps TIMESTAMP,
+        ignicion INTEGER,
+        FOREIGN KEY (dispositivo_id) REFERENCES dispositivos(id)
+    ''', 'fecha_gps'),
+    'excesos_velocidad': ('''
+        dispositivo_id TEXT,
+        placa TEXT,
+        fecha DATE,
+        velocidad REAL,
+        limite_velocidad REAL DEFAULT 80,
+        latitud REAL,
+        longitud REAL,
+        fecha_gps TIMESTAMP,
+        FOREIGN KEY (dispositivo_id) REFERENCES dispositivos(id)
+    ''', 'fecha_gps'),
+}
+
+# Meses de particiones que se crean por adelantado
+PARTICIONES_FUTURAS = int(os.getenv('PARTICIONES_FUTURAS', '3'))
+# Meses que se conservan por tabla (0 = sin límite)
+RETENCION_MESES = {
+    'viajes': int(os.getenv('RETENCION_VIAJES_MESES', '0')),
+    'reportes_gps': int(os.getenv('RETENCION_REPORTES_MESES', '0')),
+    'excesos_velocidad': int(os.getenv('RETENCION_EXCESOS_MESES', '0')),
+}
+# drop: borra las particiones vencidas; detach: las deja como tablas sueltas para archivarlas
+RETENCION_ACCION = os.getenv('RETENCION_ACCION', 'drop')
+
+
+def _inicio_mes(fecha):
+    return fecha.replace(day=1)
+
+
+def _sumar_meses(mes, meses):
+    total = mes.year * 12 + mes.month - 1 + meses
+    return mes.replace(year=total // 12, month=total % 12 + 1, day=1)
+
+
+def _tipo_tabla(cursor, tabla):
+    """'p' si está particionada, 'r' si es una tabla normal, None si no existe"""
+    cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', (tabla,))
+    fila = cursor.fetchone()
+    return fila[0] if fila else None
+
+
+def crear_particion(cursor, tabla, mes):
+    """
+    Crea la partición mensual de una tabla si no existe. Las filas de ese mes que hubieran
+    caído en la partición por defecto se mueven a la nueva antes de adjuntarla.
+    """
+    mes = _inicio_mes(mes)
+    particion = f'{tabla}_{mes:%Y_%m}'
+    cursor.execute('SELECT to_regclass(%s)', (particion,))
+    if cursor.fetchone()[0] is not None:
+        return False
+
+    siguiente = _sumar_meses(mes, 1)
+    cursor.execute(f'CREATE TABLE {particion} (LIKE {tabla} INCLUDING DEFAULTS)')
+    cursor.execute(f'''
+        WITH movidas AS (
+            DELETE FROM {tabla}_default WHERE fecha >= %s AND fecha < %s RETURNING *
+        )
+        INSERT INTO {particion} SELECT * FROM movidas
+    ''', (mes, siguiente))
+    cursor.execute(f"ALTER TABLE {tabla} ATTACH PARTITION {particion} "
+                   f"FOR VALUES FROM ('{mes.isoformat()}') TO ('{siguiente.isoformat()}')")
+    return True
+
+
+def crear_particiones_futuras(cursor, tabla, meses=PARTICIONES_FUTURAS):
+    """Asegura las particiones del mes actual y de los `meses` siguientes"""
+    actual = _inicio_mes(datetime.now().date())
+    return sum(crear_particion(cursor, tabla, _sumar_meses(actual, i)) for i in range(meses + 1))
+
+
+def crear_tabla_particionada(cursor, tabla):
+    """
+    Crea la tabla particionada por RANGE (fecha) con su partición por defecto.
+    Si existe como tabla normal (instalaciones anteriores) la migra copiando sus filas.
+    """
+    tipo = _tipo_tabla(cursor, tabla)
+    if tipo == 'p':
+        crear_particiones_futuras(cursor, tabla)
+        return
+
+    anterior = f'{tabla}_sin_particionar'
+    if tipo == 'r':
+        print(f"Migrando {tabla} a tabla particionada por mes...")
+        cursor.execute(f'ALTER TABLE {tabla} RENAME TO {anterior}')
+        cursor.execute(f'ALTER INDEX IF EXISTS {tabla}_pkey RENAME TO {anterior}_pkey')
+
+    columnas, _ = TABLAS_PARTICIONADAS[tabla]
+    cursor.execute(f'''
+        CREATE TABLE {tabla} (
+            id SERIAL,
+            {columnas.strip()},
+            PRIMARY KEY (id, fecha)
+        ) PARTITION BY RANGE (fecha)
+    ''')
+    cursor.execute(f'CREATE TABLE {tabla}_default PARTITION OF {tabla} DEFAULT')
+    crear_particiones_futuras(cursor, tabla)
+
+    if tipo == 'r':
+        cursor.execute(f'SELECT MIN(fecha), MAX(fecha) FROM {anterior}')
+        desde, hasta = cursor.fetchone()
+        if desde is not None:
+            mes = _inicio_mes(desde)
+            while mes <= hasta:
+                crear_particion(cursor, tabla, mes)
+                mes = _sumar_meses(mes, 1)
+        # Solo las columnas que existen en ambas (la tabla anterior puede ser de un esquema más viejo)
         cursor.execute('''
+            SELECT a.column_name FROM information_schema.columns a
+            JOIN information_schema.columns n
+              ON n.table_name = %s AND n.column_name = a.column_name AND n.table_schema = a.table_schema
+            WHERE a.table_name = %s AND a.table_schema = current_schema()
+            ORDER BY a.ordinal_position
+        ''', (tabla, anterior))
+        comunes = ', '.join(c for (c,) in cursor.fetchall())
+        cursor.execute(f'INSERT INTO {tabla} ({comunes}) SELECT {comunes} FROM {anterior}')
+        print(f"  {cursor.rowcount} filas copiadas a {tabla}")
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence('{tabla}', 'id'), "
+                       f"COALESCE((SELECT MAX(id) FROM {tabla}), 0) + 1, false)")
+        cursor.execute(f'DROP TABLE {anterior}')
+
+
+def aplicar_retencion(cursor, tabla, meses, accion=RETENCION_ACCION):
+    """Separa (y según accion, borra) las particiones anteriores a `meses` meses atrás"""
+    if meses <= 0:
+        return []
+    limite = _sumar_meses(_inicio_mes(datetime.now().date()), -meses)
+    cursor.execute('''
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    ''', (tabla,))
+
+    vencidas = []
+    for (particion,) in cursor.fetchall():
+        try:
+            mes = datetime.strptime(particion[len(tabla) + 1:], '%Y_%m').date()
+        except ValueError:
+            continue  # partición por defecto
+        if mes < limite:
+            vencidas.append(particion)
+
+    for particion in sorted(vencidas):
+        cursor.execute(f'ALTER TABLE {tabla} DETACH PARTITION {particion}')
+        if accion == 'drop':
+            cursor.execute(f'DROP TABLE {particion}')
+        print(f"🗑️ Retención {tabla}: partición {particion} {'eliminada' if accion == 'drop' else 'separada'}")
+    return vencidas
+
+
+def mantener_particiones():
+    """Crea las particiones de los próximos meses y aplica la retención configurada"""
+    with get_db_cursor() as cursor:
+        for tabla in TABLAS_PARTICIONADAS:
+            crear_particiones_futuras(cursor, tabla)
+            aplicar_retencion(cursor, tabla, RETENCION_MESES[tabla])
+
+
+# ==================== ESQUEMA Y MIGRACIONES ====================
+
+def _migracion_1(cursor):
+    """Esquema inicial: tablas, particiones, índices y vistas de resumen"""
+    # Tabla de dispositivos/vehículos
+    cursor.execute('''
         CREATE TABLE IF NOT EXISTS dispositivos (
             id TEXT PRIMARY KEY,
             placa TEXT UNIQUE,
@@ -89,59 +554,9 @@ def init_database():
         )
     ''')
 
-    # Tabla de viajes diarios
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS viajes (
-            id SERIAL PRIMARY KEY,
-            dispositivo_id TEXT,
-            placa TEXT,
-            fecha DATE,
-            viaje_num INTEGER,
-            hora_inicio TIMESTAMP,
-            hora_fin TIMESTAMP,
-            distancia_km REAL,
-            duracion_min REAL,
-            velocidad_max REAL,
-            lat_inicio REAL,
-            lng_inicio REAL,
-            lat_fin REAL,
-            lng_fin REAL,
-            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (dispositivo_id) REFERENCES dispositivos(id)
-        )
-    ''')
-
-    # Tabla de reportes GPS (puntos de cada viaje)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reportes_gps (
-            id SERIAL PRIMARY KEY,
-            dispositivo_id TEXT,
-            placa TEXT,
-            fecha DATE,
-            latitud REAL,
-            longitud REAL,
-            velocidad REAL,
-            fecha_gps TIMESTAMP,
-            ignicion INTEGER,
-            FOREIGN KEY (dispositivo_id) REFERENCES dispositivos(id)
-        )
-    ''')
-
-    # Tabla de excesos de velocidad
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS excesos_velocidad (
-            id SERIAL PRIMARY KEY,
-            dispositivo_id TEXT,
-            placa TEXT,
-            fecha DATE,
-            velocidad REAL,
-            limite_velocidad REAL DEFAULT 80,
-            latitud REAL,
-            longitud REAL,
-            fecha_gps TIMESTAMP,
-            FOREIGN KEY (dispositivo_id) REFERENCES dispositivos(id)
-        )
-    ''')
+    # Viajes, reportes GPS y excesos: particionadas por mes (ver TABLAS_PARTICIONADAS)
+    for tabla in TABLAS_PARTICIONADAS:
+        crear_tabla_particionada(cursor, tabla)
 
     # Tabla de resumen diario por vehículo
     cursor.execute('''
@@ -176,119 +591,435 @@ def init_database():
         )
     ''')
 
+    # Historial descargado de Geotab para días cerrados (inmutables)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS historial_geotab (
+            dispositivo_id TEXT,
+            fecha DATE,
+            tipo TEXT,
+            datos JSONB NOT NULL,
+            total_registros INTEGER DEFAULT 0,
+            fecha_descarga TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (dispositivo_id, fecha, tipo)
+        )
+    ''')
+
     # Crear índices para mejor rendimiento
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_viajes_placa_fecha ON viajes(placa, fecha)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_reportes_placa_fecha ON reportes_gps(placa, fecha)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_excesos_placa_fecha ON excesos_velocidad(placa, fecha)')
+    # Paginación de /api/excesos por (fecha_gps, id) y resumen por placa sin leer la tabla
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_excesos_fecha_gps_id ON excesos_velocidad(fecha_gps DESC, id DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_excesos_placa_fecha_gps_id ON excesos_velocidad(placa, fecha_gps DESC, id DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_excesos_fecha_resumen ON excesos_velocidad(fecha, placa, velocidad)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_resumen_fecha ON resumen_diario(fecha)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ubicaciones_placa ON ubicaciones(placa)')
+    # Claves naturales de los upserts en lote (ver guardar_ubicaciones, guardar_viajes, ...)
+    _reasignar_ubicaciones_por_id(cursor)
+    for nombre, tabla, columnas in CLAVES_UNICAS:
+        crear_indice_unico(cursor, nombre, tabla, columnas)
+    cursor.execute('DROP INDEX IF EXISTS idx_ubicaciones_placa')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_resumen_placa_fecha ON resumen_diario(placa, fecha)')
+    # BRIN sobre la columna de tiempo: mínimo costo de mantenimiento en tablas que solo crecen
+    for tabla, (_, columna_tiempo) in TABLAS_PARTICIONADAS.items():
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{tabla}_{columna_tiempo}_brin ON {tabla} USING brin ({columna_tiempo})')
+
+    # Resúmenes por semana/mes: ver _migracion_6
+
+
+def _migracion_2(cursor):
+    """Tabla consultas_lentas para los planes capturados por CursorMedido"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS consultas_lentas (
+            id SERIAL PRIMARY KEY,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            huella TEXT,
+            consulta TEXT,
+            duracion_ms REAL,
+            filas INTEGER,
+            plan TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_consultas_lentas_fecha ON consultas_lentas(fecha)')
+
+
+def _rellenar_geohash(cursor, tabla, claves):
+    """Calcula el geohash de las filas existentes, por lotes (claves: columnas que identifican la fila)"""
+    lector = cursor.connection.cursor(name=f'geohash_{tabla}')
+    lector.itersize = LOTE_INSERT
+    lector.execute(f'''
+        SELECT {', '.join(claves)}, latitud, longitud FROM {tabla}
+        WHERE geohash IS NULL AND latitud IS NOT NULL AND longitud IS NOT NULL
+    ''')
+    condicion = ' AND '.join(f't.{c} = v.{c}' for c in claves)
+    total = 0
+    while True:
+        filas = lector.fetchmany(LOTE_INSERT)
+        if not filas:
+            break
+        psycopg2.extras.execute_values(cursor, f'''
+            UPDATE {tabla} t SET geohash = v.geohash
+            FROM (VALUES %s) AS v({', '.join(claves)}, geohash)
+            WHERE {condicion}
+        ''', [f[:-2] + (codificar_geohash(f[-2], f[-1]),) for f in filas], page_size=LOTE_INSERT)
+        total += len(filas)
+    lector.close()
+    if total:
+        print(f"  geohash calculado para {total} filas de {tabla}")
+
+
+def _migracion_3(cursor):
+    """Columna geohash (collation C para búsquedas por prefijo como rango) e índices"""
+    cursor.execute('ALTER TABLE ubicaciones ADD COLUMN IF NOT EXISTS geohash TEXT COLLATE "C"')
+    cursor.execute('ALTER TABLE reportes_gps ADD COLUMN IF NOT EXISTS geohash TEXT COLLATE "C"')
+    _rellenar_geohash(cursor, 'ubicaciones', ('id',))
+    _rellenar_geohash(cursor, 'reportes_gps', ('id', 'fecha'))
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ubicaciones_geohash ON ubicaciones(geohash)')
+    # El índice de reportes_gps por geohash se crea en _migracion_4
+
+
+def _migracion_4(cursor):
+    """Índice de reportes_gps por (geohash, fecha): cada prefijo es un solo rango del índice"""
+    # Con (fecha, geohash) y varios días, el rango de geohash no acota el recorrido del índice
+    cursor.execute('DROP INDEX IF EXISTS idx_reportes_fecha_geohash')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reportes_geohash_fecha ON reportes_gps(geohash, fecha)')
+
 
-    conn.commit()
-    cursor.close()
-    conn.close()
-    print("Base de datos PostgreSQL inicializada correctamente")
+def _migracion_5(cursor):
+    """Filas de ubicaciones con el id del dispositivo como placa (bases con la migración 1 ya aplicada)"""
+    _reasignar_ubicaciones_por_id(cursor)
+
+
+def _migracion_6(cursor):
+    """Resúmenes por semana, mes y flota en tablas que se actualizan por período (reemplazan las vistas)"""
+    for vista in ('mv_resumen_placa_semana', 'mv_resumen_placa_mes', 'mv_resumen_flota_dia'):
+        cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS {vista}')
+    crear_tablas_resumen(cursor)
+    # Carga inicial con toda la historia; de aquí en adelante solo se recalcula lo que cambia
+    for tabla, (periodo, unidad) in TABLAS_ROLLUP.items():
+        cursor.execute(f'''
+            INSERT INTO {tabla} (placa, {periodo}, viajes, km_total, reportes, excesos,
+                                 suma_vel_max, dias_vel_max, tiempo_total)
+            SELECT placa, date_trunc('{unidad}', fecha)::date, {_COLUMNAS_ROLLUP}
+            FROM resumen_diario WHERE placa IS NOT NULL
+            GROUP BY placa, date_trunc('{unidad}', fecha)
+            ON CONFLICT DO NOTHING
+        ''')
+    cursor.execute('''
+        INSERT INTO resumen_flota_dia (fecha, total_km, total_viajes, total_excesos)
+        SELECT fecha, SUM(total_km), SUM(total_viajes), SUM(total_excesos)
+        FROM resumen_diario WHERE fecha IS NOT NULL GROUP BY fecha
+        ON CONFLICT DO NOTHING
+    ''')
+
+
+# (versión, descripción, función). Se agregan siempre al final y cada una debe ser idempotente:
+# las bases creadas antes de schema_version ya tienen parte del esquema
+MIGRACIONES = [
+    (1, 'Esquema inicial', _migracion_1),
+    (2, 'Registro de consultas lentas', _migracion_2),
+    (3, 'Geohash en ubicaciones y reportes_gps', _migracion_3),
+    (4, 'Índice de reportes_gps por geohash y fecha', _migracion_4),
+    (5, 'Ubicaciones por placa real en lugar del id del dispositivo', _migracion_5),
+    (6, 'Resúmenes por semana, mes y flota en tablas incrementales', _migracion_6),
+]
+
+# Clave del advisory lock que serializa las migraciones entre procesos
+CLAVE_LOCK_MIGRACIONES = 7271001
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+
+def init_database():
+    """
+    Aplica las migraciones pendientes. Se ejecuta una vez por proceso: explícitamente
+    (python database.py) o en la primera conexión tomada con get_db_connection.
+    """
+    global _esquema_listo
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            # Varios workers pueden arrancar a la vez: solo uno migra, el resto espera
+            cursor.execute('SELECT pg_advisory_lock(%s)', (CLAVE_LOCK_MIGRACIONES,))
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    descripcion TEXT,
+                    fecha_aplicada TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.commit()
+
+            cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+            actual = cursor.fetchone()[0]
+            for version, descripcion, migrar in MIGRACIONES:
+                if version <= actual:
+                    continue
+                print(f"Aplicando migración {version}: {descripcion}")
+                migrar(cursor)
+                cursor.execute('''
+                    INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)
+                ''', (version, descripcion))
+                conn.commit()
+                actual = version
+
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (CLAVE_LOCK_MIGRACIONES,))
+            cursor.close()
+        finally:
+            conn.close()
+
+        _esquema_listo = True
+        print(f"Base de datos PostgreSQL en la versión {actual} del esquema")
 
 
 def guardar_ubicacion(dispositivo_id, placa, lat, lng, velocidad, direccion, fecha_gps, comunicando):
     """Guarda o actualiza la última ubicación de un vehículo"""
+    guardar_ubicaciones([(dispositivo_id, placa, lat, lng, velocidad, direccion, fecha_gps, comunicando)])
+
+
+def guardar_ubicaciones(filas):
+    """
+    Guarda o actualiza la última ubicación de muchos vehículos en un solo INSERT ... ON CONFLICT.
+    filas: tuplas (dispositivo_id, placa, lat, lng, velocidad, direccion, fecha_gps, comunicando)
+    """
+    # ON CONFLICT no admite la misma placa dos veces en un INSERT: gana la última
+    por_placa = {fila[1]: fila for fila in filas}
+    if not por_placa:
+        return 0
+
+    ahora = datetime.now()
     with get_db_cursor() as cursor:
-        # Verificar si ya existe
-        cursor.execute('SELECT id FROM ubicaciones WHERE placa = %s', (placa,))
-        existe = cursor.fetchone()
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO ubicaciones
+            (dispositivo_id, placa, latitud, longitud, velocidad, direccion, fecha_gps, comunicando,
+             fecha_actualizacion, geohash)
+            VALUES %s
+            ON CONFLICT (placa) DO UPDATE SET
+                dispositivo_id = EXCLUDED.dispositivo_id,
+                latitud = EXCLUDED.latitud,
+                longitud = EXCLUDED.longitud,
+                geohash = EXCLUDED.geohash,
+                velocidad = EXCLUDED.velocidad,
+                direccion = EXCLUDED.direccion,
+                fecha_gps = EXCLUDED.fecha_gps,
+                comunicando = EXCLUDED.comunicando,
+                fecha_actualizacion = EXCLUDED.fecha_actualizacion
+        ''', [fila + (ahora, codificar_geohash(fila[2], fila[3])) for fila in por_placa.values()],
+            page_size=len(por_placa))
 
-        if existe:
-            cursor.execute('''
-                UPDATE ubicaciones
-                SET latitud = %s, longitud = %s, velocidad = %s, direccion = %s,
-                    fecha_gps = %s, comunicando = %s, fecha_actualizacion = %s
-                WHERE placa = %s
-            ''', (lat, lng, velocidad, direccion, fecha_gps, comunicando, datetime.now(), placa))
-        else:
-            cursor.execute('''
-                INSERT INTO ubicaciones (dispositivo_id, placa, latitud, longitud, velocidad, direccion, fecha_gps, comunicando)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (dispositivo_id, placa, lat, lng, velocidad, direccion, fecha_gps, comunicando))
+    return len(por_placa)
 
 
 def guardar_viaje(dispositivo_id, placa, fecha, viaje_num, hora_inicio, hora_fin,
                   distancia_km, duracion_min, velocidad_max, lat_inicio, lng_inicio, lat_fin, lng_fin):
     """Guarda un viaje en la base de datos"""
+    guardar_viajes([(dispositivo_id, placa, fecha, viaje_num, hora_inicio, hora_fin,
+                     distancia_km, duracion_min, velocidad_max, lat_inicio, lng_inicio, lat_fin, lng_fin)])
+
+
+def _unicas(filas, clave):
+    """Quita filas con la misma clave natural (ON CONFLICT no admite repetidas); gana la última"""
+    return list({clave(f): f for f in filas}.values())
+
+
+def guardar_viajes(filas):
+    """
+    Guarda o actualiza viajes en lote por (placa, fecha, viaje_num).
+    filas: tuplas en el orden de guardar_viaje. Retorna el conjunto de placas con viajes
+    nuevos o modificados (un viaje en curso cambia entre sincronizaciones).
+    """
+    filas = _unicas(filas, lambda f: (f[1], str(f[2]), f[3]))
+    if not filas:
+        return set()
+
     with get_db_cursor() as cursor:
-        # Verificar si ya existe este viaje
-        cursor.execute('''
-            SELECT id FROM viajes
-            WHERE placa = %s AND fecha = %s AND viaje_num = %s
-        ''', (placa, fecha, viaje_num))
-        existe = cursor.fetchone()
+        cambiadas = psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO viajes (dispositivo_id, placa, fecha, viaje_num, hora_inicio, hora_fin,
+                                distancia_km, duracion_min, velocidad_max, lat_inicio, lng_inicio, lat_fin, lng_fin)
+            VALUES %s
+            ON CONFLICT (placa, fecha, viaje_num) DO UPDATE SET
+                dispositivo_id = EXCLUDED.dispositivo_id,
+                hora_inicio = EXCLUDED.hora_inicio,
+                hora_fin = EXCLUDED.hora_fin,
+                distancia_km = EXCLUDED.distancia_km,
+                duracion_min = EXCLUDED.duracion_min,
+                velocidad_max = EXCLUDED.velocidad_max,
+                lat_inicio = EXCLUDED.lat_inicio,
+                lng_inicio = EXCLUDED.lng_inicio,
+                lat_fin = EXCLUDED.lat_fin,
+                lng_fin = EXCLUDED.lng_fin
+            WHERE (viajes.hora_inicio, viajes.hora_fin, viajes.distancia_km, viajes.duracion_min,
+                   viajes.velocidad_max, viajes.lat_fin, viajes.lng_fin)
+                  IS DISTINCT FROM
+                  (EXCLUDED.hora_inicio, EXCLUDED.hora_fin, EXCLUDED.distancia_km, EXCLUDED.duracion_min,
+                   EXCLUDED.velocidad_max, EXCLUDED.lat_fin, EXCLUDED.lng_fin)
+            RETURNING placa
+        ''', filas, page_size=LOTE_INSERT, fetch=True)
 
-        if not existe:
-            cursor.execute('''
-                INSERT INTO viajes (dispositivo_id, placa, fecha, viaje_num, hora_inicio, hora_fin,
-                                   distancia_km, duracion_min, velocidad_max, lat_inicio, lng_inicio, lat_fin, lng_fin)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (dispositivo_id, placa, fecha, viaje_num, hora_inicio, hora_fin,
-                  distancia_km, duracion_min, velocidad_max, lat_inicio, lng_inicio, lat_fin, lng_fin))
+    return {fila[0] for fila in cambiadas}
 
 
 def guardar_reporte_gps(dispositivo_id, placa, fecha, lat, lng, velocidad, fecha_gps, ignicion):
     """Guarda un punto GPS en reportes_gps"""
+    guardar_reportes_gps([(dispositivo_id, placa, fecha, lat, lng, velocidad, fecha_gps, ignicion)])
+
+
+def guardar_reportes_gps(filas):
+    """
+    Guarda puntos GPS en lote; un punto ya guardado (dispositivo_id, fecha, fecha_gps) se ignora.
+    filas: tuplas (dispositivo_id, placa, fecha, lat, lng, velocidad, fecha_gps, ignicion).
+    Retorna el número de filas enviadas.
+    """
+    filas = _unicas(filas, lambda f: (f[0], str(f[2]), f[6]))
+    if not filas:
+        return 0
+
     with get_db_cursor() as cursor:
-        cursor.execute('''
-            INSERT INTO reportes_gps (dispositivo_id, placa, fecha, latitud, longitud, velocidad, fecha_gps, ignicion)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (dispositivo_id, placa, fecha, lat, lng, velocidad, fecha_gps, 1 if ignicion else 0))
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO reportes_gps (dispositivo_id, placa, fecha, latitud, longitud, velocidad, fecha_gps, ignicion, geohash)
+            VALUES %s
+            ON CONFLICT (dispositivo_id, fecha, fecha_gps) DO NOTHING
+        ''', [f[:7] + (1 if f[7] else 0, codificar_geohash(f[3], f[4])) for f in filas], page_size=LOTE_INSERT)
+
+    return len(filas)
+
+
+# Columnas de la carga masiva de reportes_gps. Las tuplas de entrada traen todas menos
+# geohash, que se calcula al cargar
+COLUMNAS_REPORTES = ('dispositivo_id', 'placa', 'fecha', 'latitud', 'longitud', 'velocidad', 'fecha_gps', 'ignicion',
+                     'geohash')
+# Filas por cada COPY (acota la memoria del buffer CSV)
+FILAS_POR_COPY = 50000
+
+
+def _copiar_csv(cursor, tabla, columnas, filas):
+    """COPY FROM STDIN de un lote de tuplas en formato CSV (None se carga como NULL)"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(filas)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def cargar_reportes_gps(filas):
+    """
+    Carga masiva de puntos GPS: COPY a una tabla temporal y de ahí a reportes_gps, ignorando
+    los puntos repetidos (en el lote o ya guardados). filas: iterable de tuplas en el orden de
+    COLUMNAS_REPORTES (sin geohash), con ignicion True/False/None. Retorna el número de puntos nuevos.
+    """
+    cols = ', '.join(COLUMNAS_REPORTES)
+    with get_db_cursor() as cursor:
+        cursor.execute(f'''
+            CREATE TEMP TABLE reportes_gps_carga ON COMMIT DROP AS
+            SELECT {cols} FROM reportes_gps WITH NO DATA
+        ''')
+
+        lote = []
+        for fila in filas:
+            ignicion = fila[7]
+            lote.append(fila[:7] + (None if ignicion is None else int(bool(ignicion)),
+                                    codificar_geohash(fila[3], fila[4])))
+            if len(lote) >= FILAS_POR_COPY:
+                _copiar_csv(cursor, 'reportes_gps_carga', COLUMNAS_REPORTES, lote)
+                lote = []
+        if lote:
+            _copiar_csv(cursor, 'reportes_gps_carga', COLUMNAS_REPORTES, lote)
+
+        cursor.execute(f'''
+            INSERT INTO reportes_gps ({cols})
+            SELECT DISTINCT ON (dispositivo_id, fecha, fecha_gps) {cols}
+            FROM reportes_gps_carga
+            ORDER BY dispositivo_id, fecha, fecha_gps
+            ON CONFLICT (dispositivo_id, fecha, fecha_gps) DO NOTHING
+        ''')
+        return cursor.rowcount
 
 
 def guardar_exceso_velocidad(dispositivo_id, placa, fecha, velocidad, lat, lng, fecha_gps, limite=80):
     """Guarda un exceso de velocidad"""
+    guardar_excesos_velocidad([(dispositivo_id, placa, fecha, velocidad, lat, lng, fecha_gps, limite)])
+
+
+def guardar_excesos_velocidad(filas):
+    """
+    Guarda o actualiza excesos de velocidad en lote por (dispositivo_id, fecha, fecha_gps).
+    filas: tuplas (dispositivo_id, placa, fecha, velocidad, lat, lng, fecha_gps, limite).
+    Retorna el número de filas enviadas.
+    """
+    filas = _unicas(filas, lambda f: (f[0], str(f[2]), f[6]))
+    if not filas:
+        return 0
+
     with get_db_cursor() as cursor:
-        cursor.execute('''
-            INSERT INTO excesos_velocidad (dispositivo_id, placa, fecha, velocidad, limite_velocidad, latitud, longitud, fecha_gps)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (dispositivo_id, placa, fecha, velocidad, limite, lat, lng, fecha_gps))
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO excesos_velocidad (dispositivo_id, placa, fecha, velocidad, latitud, longitud, fecha_gps, limite_velocidad)
+            VALUES %s
+            ON CONFLICT (dispositivo_id, fecha, fecha_gps) DO UPDATE SET
+                velocidad = EXCLUDED.velocidad,
+                limite_velocidad = EXCLUDED.limite_velocidad
+            WHERE (excesos_velocidad.velocidad, excesos_velocidad.limite_velocidad)
+                  IS DISTINCT FROM (EXCLUDED.velocidad, EXCLUDED.limite_velocidad)
+        ''', filas, page_size=LOTE_INSERT)
+
+    return len(filas)
 
 
 def actualizar_resumen_diario(placa, fecha):
     """Actualiza el resumen diario de un vehículo"""
-    with get_db_cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-        # Obtener dispositivo_id
-        cursor.execute('SELECT id FROM dispositivos WHERE placa = %s', (placa,))
-        disp = cursor.fetchone()
-        dispositivo_id = disp['id'] if disp else None
+    actualizar_resumenes_diarios(fecha, [placa])
 
-        # Calcular estadísticas del día
-        cursor.execute('''
-            SELECT
-                COUNT(*) as total_viajes,
-                COALESCE(SUM(distancia_km), 0) as total_km,
-                COALESCE(SUM(duracion_min), 0) as tiempo_activo,
-                COALESCE(MAX(velocidad_max), 0) as velocidad_max,
-                MIN(hora_inicio) as primer_encendido,
-                MAX(hora_fin) as ultimo_apagado
-            FROM viajes
-            WHERE placa = %s AND fecha = %s
-        ''', (placa, fecha))
-        stats = cursor.fetchone()
 
-        # Contar reportes
-        cursor.execute('''
-            SELECT COUNT(*) as total FROM reportes_gps WHERE placa = %s AND fecha = %s
-        ''', (placa, fecha))
-        reportes = cursor.fetchone()
-
-        # Contar excesos
-        cursor.execute('''
-            SELECT COUNT(*) as total FROM excesos_velocidad WHERE placa = %s AND fecha = %s
-        ''', (placa, fecha))
-        excesos = cursor.fetchone()
+def actualizar_resumenes_diarios(fecha, placas=None):
+    """
+    Recalcula resumen_diario de una fecha para toda la flota (o solo las placas indicadas)
+    en un único INSERT ... SELECT ... ON CONFLICT, y con él los resúmenes por semana y mes.
+    Retorna el número de filas escritas.
+    """
+    if placas is not None:
+        placas = list(placas)
+        if not placas:
+            return 0
+    filtro = '' if placas is None else 'AND placa = ANY(%(placas)s)'
+    filtro_dispositivos = '' if placas is None else 'AND d.placa = ANY(%(placas)s)'
 
-        # Insertar o actualizar resumen (ON CONFLICT para PostgreSQL)
-        cursor.execute('''
+    with get_db_cursor() as cursor:
+        cursor.execute(f'''
+            WITH v AS (
+                SELECT placa,
+                       COUNT(*) as total_viajes,
+                       COALESCE(SUM(distancia_km), 0) as total_km,
+                       COALESCE(SUM(duracion_min), 0) as tiempo_activo,
+                       COALESCE(MAX(velocidad_max), 0) as velocidad_max,
+                       MIN(hora_inicio) as primer_encendido,
+                       MAX(hora_fin) as ultimo_apagado
+                FROM viajes WHERE fecha = %(fecha)s {filtro}
+                GROUP BY placa
+            ), r AS (
+                SELECT placa, COUNT(*) as total
+                FROM reportes_gps WHERE fecha = %(fecha)s {filtro}
+                GROUP BY placa
+            ), e AS (
+                SELECT placa, COUNT(*) as total
+                FROM excesos_velocidad WHERE fecha = %(fecha)s {filtro}
+                GROUP BY placa
+            )
             INSERT INTO resumen_diario
             (dispositivo_id, placa, fecha, total_viajes, total_km, total_reportes, total_excesos,
              hora_primer_encendido, hora_ultimo_apagado, tiempo_activo_min, velocidad_max_dia, fecha_actualizacion)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            SELECT d.id, d.placa, %(fecha)s,
+                   COALESCE(v.total_viajes, 0), COALESCE(v.total_km, 0),
+                   COALESCE(r.total, 0), COALESCE(e.total, 0),
+                   v.primer_encendido::text, v.ultimo_apagado::text,
+                   COALESCE(v.tiempo_activo, 0), COALESCE(v.velocidad_max, 0), %(ahora)s
+            FROM dispositivos d
+            LEFT JOIN v ON v.placa = d.placa
+            LEFT JOIN r ON r.placa = d.placa
+            LEFT JOIN e ON e.placa = d.placa
+            WHERE d.placa IS NOT NULL {filtro_dispositivos}
             ON CONFLICT (dispositivo_id, fecha) DO UPDATE SET
+                placa = EXCLUDED.placa,
                 total_viajes = EXCLUDED.total_viajes,
                 total_km = EXCLUDED.total_km,
                 total_reportes = EXCLUDED.total_reportes,
@@ -298,18 +1029,140 @@ def actualizar_resumen_diario(placa, fecha):
                 tiempo_activo_min = EXCLUDED.tiempo_activo_min,
                 velocidad_max_dia = EXCLUDED.velocidad_max_dia,
                 fecha_actualizacion = EXCLUDED.fecha_actualizacion
-        ''', (
-            dispositivo_id, placa, fecha,
-            stats['total_viajes'] or 0,
-            stats['total_km'] or 0,
-            reportes['total'] or 0,
-            excesos['total'] or 0,
-            stats['primer_encendido'],
-            stats['ultimo_apagado'],
-            stats['tiempo_activo'] or 0,
-            stats['velocidad_max'] or 0,
-            datetime.now()
-        ))
+        ''', {'fecha': fecha, 'placas': placas, 'ahora': datetime.now()})
+        escritas = cursor.rowcount
+        # Semana, mes y total de flota afectados, en la misma transacción
+        _acumular_resumenes(cursor, fecha, placas)
+        return escritas
+
+
+# ==================== RESÚMENES ACUMULADOS ====================
+
+# Columnas acumulables de resumen_diario; la velocidad máxima promedio se guarda como
+# suma y conteo para poder combinar semanas, meses y días sueltos
+_COLUMNAS_ROLLUP = '''
+    SUM(total_viajes) as viajes,
+    SUM(total_km) as km_total,
+    SUM(total_reportes) as reportes,
+    SUM(total_excesos) as excesos,
+    SUM(velocidad_max_dia) as suma_vel_max,
+    COUNT(velocidad_max_dia) as dias_vel_max,
+    SUM(tiempo_activo_min) as tiempo_total
+'''
+
+# tabla -> (columna del período, unidad de date_trunc); clave (placa, período)
+TABLAS_ROLLUP = {
+    'resumen_placa_semana': ('semana', 'week'),
+    'resumen_placa_mes': ('mes', 'month'),
+}
+
+
+def crear_tablas_resumen(cursor):
+    """Tablas de resúmenes por semana y mes de cada placa, y totales diarios de la flota"""
+    for tabla, (periodo, _) in TABLAS_ROLLUP.items():
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {tabla} (
+                placa TEXT NOT NULL,
+                {periodo} DATE NOT NULL,
+                viajes BIGINT,
+                km_total DOUBLE PRECISION,
+                reportes BIGINT,
+                excesos BIGINT,
+                suma_vel_max DOUBLE PRECISION,
+                dias_vel_max BIGINT,
+                tiempo_total DOUBLE PRECISION,
+                PRIMARY KEY (placa, {periodo})
+            )
+        ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_flota_dia (
+            fecha DATE PRIMARY KEY,
+            total_km DOUBLE PRECISION,
+            total_viajes BIGINT,
+            total_excesos BIGINT
+        )
+    ''')
+
+
+def _acumular_resumenes(cursor, fecha, placas=None):
+    """
+    Recalcula desde resumen_diario solo la semana y el mes que contienen `fecha`
+    (para las placas indicadas, o toda la flota) y el total de la flota de ese día
+    """
+    filtro = '' if placas is None else 'AND placa = ANY(%(placas)s)'
+    for tabla, (periodo, unidad) in TABLAS_ROLLUP.items():
+        rango = (f"fecha >= date_trunc('{unidad}', %(fecha)s::date) "
+                 f"AND fecha < date_trunc('{unidad}', %(fecha)s::date) + interval '1 {unidad}'")
+        cursor.execute(f'''
+            INSERT INTO {tabla} (placa, {periodo}, viajes, km_total, reportes, excesos,
+                                 suma_vel_max, dias_vel_max, tiempo_total)
+            SELECT placa, date_trunc('{unidad}', %(fecha)s::date)::date, {_COLUMNAS_ROLLUP}
+            FROM resumen_diario
+            WHERE {rango} AND placa IS NOT NULL {filtro}
+            GROUP BY placa
+            ON CONFLICT (placa, {periodo}) DO UPDATE SET
+                viajes = EXCLUDED.viajes,
+                km_total = EXCLUDED.km_total,
+                reportes = EXCLUDED.reportes,
+                excesos = EXCLUDED.excesos,
+                suma_vel_max = EXCLUDED.suma_vel_max,
+                dias_vel_max = EXCLUDED.dias_vel_max,
+                tiempo_total = EXCLUDED.tiempo_total
+        ''', {'fecha': fecha, 'placas': placas})
+        if placas is None:
+            # Placas que ya no tienen días en el período (p. ej. un dispositivo renombrado)
+            cursor.execute(f'''
+                DELETE FROM {tabla} t
+                WHERE t.{periodo} = date_trunc('{unidad}', %(fecha)s::date)::date
+                  AND NOT EXISTS (SELECT 1 FROM resumen_diario WHERE placa = t.placa AND {rango})
+            ''', {'fecha': fecha})
+
+    cursor.execute('''
+        INSERT INTO resumen_flota_dia (fecha, total_km, total_viajes, total_excesos)
+        SELECT %(fecha)s, COALESCE(SUM(total_km), 0), COALESCE(SUM(total_viajes), 0),
+               COALESCE(SUM(total_excesos), 0)
+        FROM resumen_diario WHERE fecha = %(fecha)s
+        ON CONFLICT (fecha) DO UPDATE SET
+            total_km = EXCLUDED.total_km,
+            total_viajes = EXCLUDED.total_viajes,
+            total_excesos = EXCLUDED.total_excesos
+    ''', {'fecha': fecha})
+
+
+def segmentar_rango(fecha_inicio, fecha_fin):
+    """
+    Divide [fecha_inicio, fecha_fin] en meses completos, semanas completas (lunes a domingo)
+    y días sueltos, sin solapamientos. Retorna (meses, semanas, dias) como listas de date.
+    """
+    meses, semanas, dias = [], [], []
+
+    def semanas_y_dias(desde, hasta):
+        dia = desde
+        while dia <= hasta:
+            if dia.weekday() == 0 and dia + timedelta(days=6) <= hasta:
+                semanas.append(dia)
+                dia += timedelta(days=7)
+            else:
+                dias.append(dia)
+                dia += timedelta(days=1)
+
+    # Primer mes completo dentro del rango
+    mes = fecha_inicio if fecha_inicio.day == 1 else (fecha_inicio.replace(day=28) + timedelta(days=4)).replace(day=1)
+    inicio_meses = mes
+    while True:
+        siguiente = (mes.replace(day=28) + timedelta(days=4)).replace(day=1)
+        if siguiente - timedelta(days=1) > fecha_fin:
+            break
+        meses.append(mes)
+        mes = siguiente
+
+    if not meses:
+        semanas_y_dias(fecha_inicio, fecha_fin)
+    else:
+        semanas_y_dias(fecha_inicio, inicio_meses - timedelta(days=1))
+        semanas_y_dias(mes, fecha_fin)
+
+    return meses, semanas, dias
 
 
 def get_vehiculos_sin_reportar(dias=1):
@@ -334,21 +1187,38 @@ def get_vehiculos_sin_reportar(dias=1):
 
 def get_estadisticas_por_fecha(fecha_inicio, fecha_fin):
     """Obtiene estadísticas agregadas por rango de fechas"""
+    if isinstance(fecha_inicio, str):
+        fecha_inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d').date()
+    if isinstance(fecha_fin, str):
+        fecha_fin = datetime.strptime(fecha_fin, '%Y-%m-%d').date()
+    meses, semanas, dias = segmentar_rango(fecha_inicio, fecha_fin)
+
+    # Meses y semanas completos salen de los resúmenes acumulados; solo los días
+    # sueltos de los extremos se leen de resumen_diario
     with get_db_cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
         cursor.execute('''
             SELECT
                 placa,
-                SUM(total_viajes) as viajes,
-                SUM(total_km) as km_total,
-                SUM(total_reportes) as reportes,
-                SUM(total_excesos) as excesos,
-                AVG(velocidad_max_dia) as vel_max_promedio,
-                SUM(tiempo_activo_min) as tiempo_total
-            FROM resumen_diario
-            WHERE fecha BETWEEN %s AND %s
+                SUM(viajes) as viajes,
+                SUM(km_total) as km_total,
+                SUM(reportes) as reportes,
+                SUM(excesos) as excesos,
+                SUM(suma_vel_max) / NULLIF(SUM(dias_vel_max), 0) as vel_max_promedio,
+                SUM(tiempo_total) as tiempo_total
+            FROM (
+                SELECT placa, viajes, km_total, reportes, excesos, suma_vel_max, dias_vel_max, tiempo_total
+                FROM resumen_placa_mes WHERE mes = ANY(%s::date[])
+                UNION ALL
+                SELECT placa, viajes, km_total, reportes, excesos, suma_vel_max, dias_vel_max, tiempo_total
+                FROM resumen_placa_semana WHERE semana = ANY(%s::date[])
+                UNION ALL
+                SELECT placa, total_viajes, total_km, total_reportes, total_excesos,
+                       velocidad_max_dia, (velocidad_max_dia IS NOT NULL)::int, tiempo_activo_min
+                FROM resumen_diario WHERE fecha = ANY(%s::date[])
+            ) rango
             GROUP BY placa
             ORDER BY km_total DESC
-        ''', (fecha_inicio, fecha_fin))
+        ''', (meses, semanas, dias))
 
         return [dict(row) for row in cursor.fetchall()]
 
@@ -364,6 +1234,58 @@ def get_resumen_por_placa_fecha(placa, fecha):
         return dict(resultado) if resultado else None
 
 
+def _condicion_geohash(prefijos):
+    """(sql, params) con un rango por prefijo sobre la columna geohash, para usar su índice"""
+    if not prefijos:
+        return 'FALSE', []
+    condicion = ' OR '.join(['(geohash >= %s AND geohash < %s)'] * len(prefijos))
+    # '~' ordena después de todos los caracteres de geohash (collation C)
+    return f'({condicion})', [v for p in prefijos for v in (p, p + '~')]
+
+
+def get_ubicaciones_en_celdas(prefijos):
+    """Última ubicación de los vehículos cuyas celdas de geohash empiezan por alguno de los prefijos"""
+    condicion, params = _condicion_geohash(prefijos)
+    with get_db_cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+        cursor.execute(f'''
+            SELECT placa, latitud, longitud, velocidad, direccion, fecha_gps, comunicando
+            FROM ubicaciones WHERE {condicion}
+        ''', params)
+
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def iterar_reportes_en_celdas(prefijos, fecha_inicio, fecha_fin):
+    """Puntos GPS de un rango de fechas dentro de las celdas de geohash (cursor del lado del servidor)"""
+    condicion, params = _condicion_geohash(prefijos)
+    return iterar_consulta(f'''
+        SELECT placa, latitud, longitud, velocidad, fecha_gps
+        FROM reportes_gps
+        WHERE fecha BETWEEN %s AND %s AND {condicion}
+    ''', [fecha_inicio, fecha_fin] + params, nombre='reportes_en_zona')
+
+
+def leer_historial_dia(dispositivo_id, fecha, tipos):
+    """Retorna {tipo: datos} del historial guardado de un dispositivo en un día"""
+    with get_db_cursor() as cursor:
+        cursor.execute('''
+            SELECT tipo, datos FROM historial_geotab
+            WHERE dispositivo_id = %s AND fecha = %s AND tipo = ANY(%s)
+        ''', (dispositivo_id, fecha, list(tipos)))
+
+        return {tipo: datos for tipo, datos in cursor.fetchall()}
+
+
+def guardar_historial_dia(dispositivo_id, fecha, tipo, datos):
+    """Guarda el historial de un día cerrado (no se sobrescribe)"""
+    with get_db_cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO historial_geotab (dispositivo_id, fecha, tipo, datos, total_registros)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (dispositivo_id, fecha, tipo) DO NOTHING
+        ''', (dispositivo_id, fecha, tipo, psycopg2.extras.Json(datos), len(datos)))
+
+
 def log_sync(tipo, registros, estado='OK', mensaje=''):
     """Registra una sincronización"""
     with get_db_cursor() as cursor:
@@ -373,5 +1295,5 @@ def log_sync(tipo, registros, estado='OK', mensaje=''):
         ''', (tipo, registros, estado, mensaje))
 
 
-# Inicializar BD al importar
-init_database()
+if __name__ == '__main__':
+    init_database()
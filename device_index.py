@@ -0,0 +1,108 @@
+"""
+Índice en memoria placa → dispositivo de Geotab
+- Compartido por las rutas de app.py y por SyncService.sync_dispositivos
+- Se recarga al vencer el TTL, tras invalidar() o ante una placa/id desconocido (con límite);
+  si Geotab falla usa la tabla dispositivos
+"""
+import os
+import threading
+import time
+import psycopg2.extras
+from dotenv import load_dotenv
+
+from database import get_db_cursor
+
+load_dotenv()
+
+# Segundos de vigencia del índice (sync_dispositivos lo refresca cada 5 minutos)
+DEVICE_INDEX_TTL = int(os.getenv('DEVICE_INDEX_TTL', '600'))
+# Mínimo de segundos entre recargas provocadas por una placa o id desconocido
+DEVICE_INDEX_RECARGA_MIN = int(os.getenv('DEVICE_INDEX_RECARGA_MIN', '30'))
+
+
+class DeviceIndex:
+    def __init__(self, ttl=DEVICE_INDEX_TTL, recarga_min=DEVICE_INDEX_RECARGA_MIN):
+        self.ttl = ttl
+        self.recarga_min = recarga_min
+        self._ultima_recarga_fallo = None
+        self.cargar_remoto = None  # función que retorna la lista Device de Geotab
+        self._lock = threading.Lock()
+        self._por_placa = {}
+        self._por_id = {}
+        self._actualizado = None
+
+    def actualizar(self, devices):
+        """Reemplaza el índice con una lista de entidades Device de Geotab"""
+        por_placa = {}
+        por_id = {}
+        for d in devices:
+            entrada = {'id': d.get('id'), 'placa': d.get('name'), 'serial': d.get('serialNumber', '')}
+            por_id[entrada['id']] = entrada
+            if entrada['placa']:
+                por_placa[entrada['placa']] = entrada
+        self._por_placa = por_placa
+        self._por_id = por_id
+        self._actualizado = time.monotonic()
+
+    def _cargar_desde_bd(self):
+        with get_db_cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute('SELECT id, placa, serial_number FROM dispositivos WHERE activo = 1')
+            return [{'id': r['id'], 'name': r['placa'], 'serialNumber': r['serial_number']}
+                    for r in cursor.fetchall()]
+
+    def _asegurar(self):
+        """Recarga el índice si venció (una sola recarga a la vez)"""
+        if self._actualizado is not None and time.monotonic() - self._actualizado < self.ttl:
+            return
+        with self._lock:
+            if self._actualizado is not None and time.monotonic() - self._actualizado < self.ttl:
+                return
+            try:
+                if self.cargar_remoto is None:
+                    raise RuntimeError("sin fuente remota configurada")
+                devices = self.cargar_remoto()
+            except Exception as e:
+                print(f"âš ï¸ Índice de dispositivos desde BD ({e})")
+                devices = self._cargar_desde_bd()
+            self.actualizar(devices)
+
+    def invalidar(self):
+        """Fuerza la recarga en la próxima consulta"""
+        self._actualizado = None
+
+    def _recargar_por_fallo(self):
+        """Ante una placa o id desconocido (p. ej. un vehículo recién registrado) recarga el
+        índice, como máximo una vez cada recarga_min segundos. Retorna True si recargó"""
+        with self._lock:
+            ahora = time.monotonic()
+            if self._ultima_recarga_fallo is not None and ahora - self._ultima_recarga_fallo < self.recarga_min:
+                return False
+            self._ultima_recarga_fallo = ahora
+        self.invalidar()
+        self._asegurar()
+        return True
+
+    def buscar_id(self, placa):
+        """Retorna el id de Geotab de una placa, o None si no existe"""
+        self._asegurar()
+        entrada = self._por_placa.get(placa)
+        if entrada is None and placa and self._recargar_por_fallo():
+            entrada = self._por_placa.get(placa)
+        return entrada['id'] if entrada else None
+
+    def por_id(self, device_id):
+        """Retorna {'id', 'placa', 'serial'} de un dispositivo, o None"""
+        self._asegurar()
+        entrada = self._por_id.get(device_id)
+        if entrada is None and device_id and self._recargar_por_fallo():
+            entrada = self._por_id.get(device_id)
+        return entrada
+
+    def dispositivos(self):
+        """Lista de {'id', 'placa', 'serial'} ordenada por placa"""
+        self._asegurar()
+        return sorted(self._por_id.values(), key=lambda x: x['placa'] or '')
+
+
+# Instancia global del índice
+device_index = DeviceIndex()
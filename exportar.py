@@ -0,0 +1,71 @@
+"""
+Exportaciones en streaming (CSV o NDJSON) de viajes, excesos y resumen diario
+- Las filas se leen con un cursor del lado del servidor (ver database.iterar_consulta)
+- Se emiten en bloques, sin armar la respuesta completa en memoria
+"""
+import csv
+import io
+
+from compacto import dumps
+
+# tipo -> (tabla, columnas exportadas, orden)
+EXPORTACIONES = {
+    'viajes': ('viajes', (
+        'placa', 'fecha', 'viaje_num', 'hora_inicio', 'hora_fin', 'distancia_km',
+        'duracion_min', 'velocidad_max', 'lat_inicio', 'lng_inicio', 'lat_fin', 'lng_fin'
+    ), 'fecha, placa, viaje_num'),
+    'excesos': ('excesos_velocidad', (
+        'placa', 'fecha', 'fecha_gps', 'velocidad', 'limite_velocidad', 'latitud', 'longitud'
+    ), 'fecha_gps, id'),
+    'resumen_diario': ('resumen_diario', (
+        'placa', 'fecha', 'total_viajes', 'total_km', 'total_reportes', 'total_excesos',
+        'hora_primer_encendido', 'hora_ultimo_apagado', 'tiempo_activo_min', 'velocidad_max_dia'
+    ), 'fecha, placa'),
+}
+
+# Filas por bloque enviado al cliente
+FILAS_POR_BLOQUE = 1000
+
+
+def consulta_exportacion(tipo, fecha_inicio, fecha_fin, placa=None):
+    """Retorna (consulta, params, columnas) para un tipo de EXPORTACIONES"""
+    tabla, columnas, orden = EXPORTACIONES[tipo]
+    condiciones = 'fecha BETWEEN %s AND %s'
+    params = [fecha_inicio, fecha_fin]
+    if placa:
+        condiciones += ' AND placa = %s'
+        params.append(placa)
+    consulta = f"SELECT {', '.join(columnas)} FROM {tabla} WHERE {condiciones} ORDER BY {orden}"
+    return consulta, params, columnas
+
+
+def _bloques(filas, tamano=FILAS_POR_BLOQUE):
+    bloque = []
+    for fila in filas:
+        bloque.append(fila)
+        if len(bloque) >= tamano:
+            yield bloque
+            bloque = []
+    if bloque:
+        yield bloque
+
+
+def en_csv(columnas, filas):
+    """Genera el CSV en bloques de bytes (con BOM para que Excel lea bien las tildes)"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write('\ufeff')
+    escritor.writerow(columnas)
+    yield buffer.getvalue().encode('utf-8')
+
+    for bloque in _bloques(filas):
+        buffer.seek(0)
+        buffer.truncate()
+        escritor.writerows([fila[c] for c in columnas] for fila in bloque)
+        yield buffer.getvalue().encode('utf-8')
+
+
+def en_ndjson(filas):
+    """Genera un objeto JSON por línea, en bloques de bytes"""
+    for bloque in _bloques(filas):
+        yield b''.join(dumps(dict(fila)) + b'\n' for fila in bloque)
@@ -0,0 +1,212 @@
+"""
+Snapshot en memoria del estado de la flota
+- Todos los clientes de /api/ubicaciones se sirven del mismo snapshot
+- Un solo refresco contra Geotab a la vez (single-flight)
+- Si el snapshot venció se sirve el anterior mientras se refresca en segundo plano
+- Cada refresco con cambios incrementa una versión; cada vehículo recuerda la versión
+  en que cambió por última vez, para enviar solo los cambios (SSE y cursores)
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Segundos que un snapshot se considera fresco
+SNAPSHOT_TTL = int(os.getenv('UBICACIONES_CACHE_TTL', '30'))
+
+
+class FleetSnapshot:
+    def __init__(self, construir, ttl=SNAPSHOT_TTL, clave=None, cambio=None):
+        """
+        construir: función sin argumentos que consulta Geotab y retorna la lista de vehículos
+        clave: función vehículo -> identificador estable (por defecto la placa)
+        cambio: función (anterior, nuevo) -> True si el vehículo cambió
+        """
+        self.construir = construir
+        self.ttl = ttl
+        self.clave = clave or (lambda v: v.get('placa'))
+        self.cambio = cambio or (lambda a, b: a != b)
+        self._lock = threading.Lock()
+        self._refresco_terminado = threading.Condition(self._lock)
+        self._nueva_version = threading.Condition(self._lock)
+        self._hay_suscriptores = threading.Condition(self._lock)
+        self._refrescando = False
+        self._datos = None
+        self._actualizado = 0.0
+        self._fallo = None  # momento del último refresco fallido
+        self.ultimo_error = None
+
+        # Versionado: el cursor incluye el arranque del proceso para detectar reinicios
+        self._arranque = int(time.time())
+        self.version = 0
+        self._por_clave = {}
+        self._versiones = {}   # clave -> versión del último cambio
+        self._eliminados = {}  # clave -> versión en que desapareció
+        self._suscriptores = 0
+        self._poller = None
+
+    def _aplicar(self, datos):
+        """Registra qué vehículos cambiaron respecto al snapshot anterior. Requiere _lock"""
+        nuevos = {self.clave(v): v for v in datos}
+        version = self.version + 1
+        hubo_cambios = False
+
+        for k, v in nuevos.items():
+            anterior = self._por_clave.get(k)
+            if anterior is None or self.cambio(anterior, v):
+                self._versiones[k] = version
+                hubo_cambios = True
+            self._eliminados.pop(k, None)
+
+        for k in self._por_clave.keys() - nuevos.keys():
+            self._versiones.pop(k, None)
+            self._eliminados[k] = version
+            hubo_cambios = True
+
+        self._por_clave = nuevos
+        if hubo_cambios:
+            self.version = version
+            self._nueva_version.notify_all()
+
+    def _refrescar(self):
+        """Ejecuta el refresco; solo lo llama quien marcó _refrescando"""
+        datos = None
+        error = None
+        try:
+            datos = self.construir()
+        except Exception as e:
+            error = e
+            print(f"âŒ Error refrescando snapshot de flota: {e}")
+
+        with self._lock:
+            if error is None:
+                self._datos = datos
+                self._actualizado = time.monotonic()
+                self._fallo = None
+                self._aplicar(datos)
+            else:
+                self._fallo = time.monotonic()
+            self.ultimo_error = error
+            self._refrescando = False
+            self._refresco_terminado.notify_all()
+
+    def _lanzar_refresco(self):
+        """Marca un refresco en curso; retorna False si ya había uno o si el último falló
+        hace menos de ttl (con Geotab limitando, no reintentar en cada request). Requiere _lock"""
+        if self._refrescando:
+            return False
+        if self._fallo is not None and time.monotonic() - self._fallo < self.ttl:
+            return False
+        self._refrescando = True
+        return True
+
+    def obtener(self):
+        """Retorna el snapshot vigente, refrescándolo si es necesario"""
+        with self._lock:
+            if self._datos is not None:
+                # Stale-while-revalidate: responder ya y refrescar en segundo plano
+                if self.edad() >= self.ttl and self._lanzar_refresco():
+                    threading.Thread(target=self._refrescar, daemon=True).start()
+                return self._datos
+            propio = self._lanzar_refresco()
+
+        # Primera carga: un solo hilo consulta Geotab, el resto espera su resultado
+        if propio:
+            self._refrescar()
+
+        with self._lock:
+            while self._refrescando:
+                self._refresco_terminado.wait()
+            if self._datos is None:
+                raise RuntimeError(f"Snapshot de flota no disponible: {self.ultimo_error}")
+            return self._datos
+
+    def obtener_con_cursor(self):
+        """(snapshot vigente, cursor de esa misma versión), para continuar con solo los cambios"""
+        while True:
+            datos = self.obtener()
+            with self._lock:
+                # Si otro hilo lo reemplazó entre medio, el cursor no correspondería a estos datos
+                if self._datos is datos:
+                    return datos, self.cursor()
+
+    def edad(self):
+        """Segundos desde el último refresco exitoso"""
+        if self._datos is None:
+            return None
+        return time.monotonic() - self._actualizado
+
+    def invalidar(self):
+        """Fuerza que la próxima lectura dispare un refresco"""
+        with self._lock:
+            self._actualizado = 0.0
+            self._fallo = None
+
+    # ==================== CAMBIOS POR VERSIÓN ====================
+
+    def cursor(self, version=None):
+        """Cursor opaco '<arranque>.<versión>' para la versión indicada (o la actual)"""
+        return f"{self._arranque}.{self.version if version is None else version}"
+
+    def _version_de(self, cursor):
+        """Versión de un cursor; 0 si es inválido o de otro arranque del proceso"""
+        try:
+            arranque, version = str(cursor).split('.')
+            arranque, version = int(arranque), int(version)
+        except (TypeError, ValueError):
+            return 0
+        if arranque != self._arranque or version > self.version:
+            return 0
+        return version
+
+    def cambios_desde(self, cursor=None):
+        """
+        Vehículos que cambiaron después del cursor.
+        Sin cursor (o con uno inválido) retorna la flota completa con completo=True.
+        """
+        with self._lock:
+            desde = self._version_de(cursor)
+            return {
+                'cursor': self.cursor(),
+                'completo': desde == 0,
+                'cambios': [v for k, v in self._por_clave.items() if self._versiones.get(k, 0) > desde],
+                'eliminados': [k for k, ver in self._eliminados.items() if ver > desde and desde > 0]
+            }
+
+    def esperar_cambios(self, cursor, timeout):
+        """Bloquea hasta que haya una versión posterior al cursor; False si venció el timeout"""
+        with self._lock:
+            desde = self._version_de(cursor)
+            if self.version > desde:
+                return True
+            return self._nueva_version.wait_for(lambda: self.version > desde, timeout)
+
+    # ==================== POLLER PARA SUSCRIPTORES ====================
+
+    def _loop_poller(self):
+        """Un único hilo refresca el snapshot cada TTL mientras haya suscriptores"""
+        while True:
+            with self._lock:
+                self._hay_suscriptores.wait_for(lambda: self._suscriptores > 0)
+                propio = self._lanzar_refresco()
+            if propio:
+                self._refrescar()
+            time.sleep(self.ttl)
+
+    @contextmanager
+    def suscripcion(self):
+        """Registra un cliente en tiempo real; arranca el poller la primera vez"""
+        with self._lock:
+            self._suscriptores += 1
+            self._hay_suscriptores.notify_all()
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._loop_poller, daemon=True)
+                self._poller.start()
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._suscriptores -= 1
@@ -0,0 +1,193 @@
+"""
+Utilidades geográficas sin dependencias externas
+- Distancia haversine
+- Simplificación de trazados (Douglas-Peucker) conservando puntos obligatorios
+- Índice espacial por grilla y agrupación en clusters por zoom
+- Geohash y prefijos que cubren un rectángulo (búsquedas por rango en PostgreSQL)
+"""
+import math
+
+RADIO_TIERRA_M = 6371000.0
+
+
+def distancia_m(lat1, lng1, lat2, lng2):
+    """Distancia haversine en metros entre dos coordenadas"""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def tolerancia_por_zoom(zoom, lat=4.6):
+    """Metros que ocupa un pixel en el zoom de Leaflet (tiles de 256 px) a esa latitud"""
+    return 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+
+def _proyectar(puntos):
+    """Proyección equirectangular local a metros; suficiente para distancias cortas"""
+    if not puntos:
+        return []
+    lat0 = math.radians(sum(p[0] for p in puntos) / len(puntos))
+    k = math.pi / 180 * RADIO_TIERRA_M
+    return [(p[1] * k * math.cos(lat0), p[0] * k) for p in puntos]
+
+
+def _distancia_segmento(p, a, b):
+    """Distancia perpendicular en metros de p al segmento a-b (coordenadas proyectadas)"""
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)
+    t = max(0.0, min(1.0, t))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def simplificar(puntos, tolerancia_m, obligatorios=()):
+    """
+    Douglas-Peucker sobre [(lat, lng), ...]. Retorna los índices conservados en orden.
+    Los índices en `obligatorios` (y el primero y último) siempre se conservan.
+    """
+    n = len(puntos)
+    if n <= 2 or tolerancia_m <= 0:
+        return list(range(n))
+
+    xy = _proyectar(puntos)
+    conservar = [False] * n
+    conservar[0] = conservar[-1] = True
+    for i in obligatorios:
+        conservar[i] = True
+
+    # Cada tramo entre dos puntos obligatorios se simplifica por separado
+    anclas = [i for i in range(n) if conservar[i]]
+    pila = list(zip(anclas, anclas[1:]))
+    while pila:
+        inicio, fin = pila.pop()
+        if fin - inicio < 2:
+            continue
+        max_dist = -1.0
+        max_i = inicio
+        a = xy[inicio]
+        b = xy[fin]
+        for i in range(inicio + 1, fin):
+            d = _distancia_segmento(xy[i], a, b)
+            if d > max_dist:
+                max_dist = d
+                max_i = i
+        if max_dist > tolerancia_m:
+            conservar[max_i] = True
+            pila.append((inicio, max_i))
+            pila.append((max_i, fin))
+
+    return [i for i in range(n) if conservar[i]]
+
+
+def grados_por_pixel(zoom):
+    """Grados de longitud que ocupa un pixel en el zoom de Leaflet (tiles de 256 px)"""
+    return 360.0 / (256 * 2 ** zoom)
+
+
+class IndiceGrilla:
+    """Índice espacial por celdas de tamaño fijo (en grados) sobre elementos con 'lat' y 'lng'"""
+
+    def __init__(self, elementos, celda_grados=0.1):
+        self.celda = celda_grados
+        self.celdas = {}
+        for e in elementos:
+            self.celdas.setdefault(self._celda(e['lat'], e['lng']), []).append(e)
+
+    def _celda(self, lat, lng):
+        return (math.floor(lat / self.celda), math.floor(lng / self.celda))
+
+    def en_bbox(self, sur, oeste, norte, este):
+        """Elementos dentro del rectángulo (sin cruzar el antimeridiano)"""
+        f0, c0 = self._celda(sur, oeste)
+        f1, c1 = self._celda(norte, este)
+        if (f1 - f0 + 1) * (c1 - c0 + 1) > len(self.celdas):
+            # Rectángulo muy grande: es más barato recorrer las celdas ocupadas
+            candidatos = (e for lista in self.celdas.values() for e in lista)
+        else:
+            candidatos = (e for f in range(f0, f1 + 1) for c in range(c0, c1 + 1)
+                          for e in self.celdas.get((f, c), ()))
+        return [e for e in candidatos if sur <= e['lat'] <= norte and oeste <= e['lng'] <= este]
+
+
+def agrupar_en_clusters(elementos, zoom, radio_px=80):
+    """Agrupa elementos en celdas de ~radio_px pixeles al zoom dado; retorna listas de elementos"""
+    tam = grados_por_pixel(zoom) * radio_px
+    grupos = {}
+    for e in elementos:
+        grupos.setdefault((math.floor(e['lat'] / tam), math.floor(e['lng'] / tam)), []).append(e)
+    return list(grupos.values())
+
+
+# ==================== GEOHASH ====================
+
+BASE32_GEOHASH = '0123456789bcdefghjkmnpqrstuvwxyz'
+PRECISION_GEOHASH = 9  # celdas de ~5 m; es la precisión que se guarda en la base de datos
+
+
+def codificar_geohash(lat, lng, precision=PRECISION_GEOHASH):
+    """Geohash de una coordenada; None si no hay coordenada"""
+    if lat is None or lng is None:
+        return None
+    lat_rango = [-90.0, 90.0]
+    lng_rango = [-180.0, 180.0]
+    salida = []
+    bits = 0
+    valor = 0
+    es_lng = True
+    while len(salida) < precision:
+        rango, v = (lng_rango, lng) if es_lng else (lat_rango, lat)
+        medio = (rango[0] + rango[1]) / 2
+        valor <<= 1
+        if v >= medio:
+            valor |= 1
+            rango[0] = medio
+        else:
+            rango[1] = medio
+        es_lng = not es_lng
+        bits += 1
+        if bits == 5:
+            salida.append(BASE32_GEOHASH[valor])
+            bits = 0
+            valor = 0
+    return ''.join(salida)
+
+
+def tamano_celda_geohash(precision):
+    """(alto, ancho) en grados de una celda de geohash"""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def geohashes_en_bbox(sur, oeste, norte, este, max_celdas=32):
+    """
+    Prefijos de geohash que cubren el rectángulo, con la mayor precisión que no pase de
+    max_celdas. Cada prefijo se consulta como un rango sobre una columna indexada.
+    """
+    sur, norte = max(sur, -90.0), min(norte, 90.0)
+    oeste, este = max(oeste, -180.0), min(este, 180.0)
+    celdas = ['']
+    for precision in range(1, PRECISION_GEOHASH + 1):
+        alto, ancho = tamano_celda_geohash(precision)
+        f0 = math.floor((sur + 90) / alto)
+        f1 = min(math.floor((norte + 90) / alto), int(180 / alto) - 1)
+        c0 = math.floor((oeste + 180) / ancho)
+        c1 = min(math.floor((este + 180) / ancho), int(360 / ancho) - 1)
+        if (f1 - f0 + 1) * (c1 - c0 + 1) > max_celdas:
+            break
+        celdas = sorted({
+            codificar_geohash(-90 + (f + 0.5) * alto, -180 + (c + 0.5) * ancho, precision)
+            for f in range(f0, f1 + 1) for c in range(c0, c1 + 1)
+        })
+    return celdas
+
+
+def bbox_de_radio(lat, lng, radio_m):
+    """(sur, oeste, norte, este) del rectángulo que contiene el círculo"""
+    dlat = math.degrees(radio_m / RADIO_TIERRA_M)
+    dlng = math.degrees(radio_m / (RADIO_TIERRA_M * max(math.cos(math.radians(lat)), 1e-6)))
+    return lat - dlat, lng - dlng, lat + dlat, lng + dlng
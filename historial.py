@@ -0,0 +1,97 @@
+"""
+Lectura a través de la tabla historial_geotab para días cerrados
+- Un día cerrado se descarga de Geotab una sola vez y luego se sirve desde PostgreSQL
+- El día en curso (y los recientes dentro del margen) siempre se consultan a Geotab
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+from database import leer_historial_dia, guardar_historial_dia
+
+load_dotenv()
+
+# Horas después de medianoche UTC en que un día se considera cerrado
+# (los equipos pueden subir datos atrasados)
+MARGEN_CIERRE = timedelta(hours=int(os.getenv('HISTORIAL_MARGEN_HORAS', '6')))
+
+# Campos que se guardan por tipo de entidad, en el orden de cada fila
+CAMPOS = {
+    'Trip': ('start', 'stop', 'distance', 'drivingDuration', 'maximumSpeed', 'stopCount',
+             'startLatitude', 'startLongitude', 'stopLatitude', 'stopLongitude'),
+    'LogRecord': ('dateTime', 'latitude', 'longitude', 'speed'),
+    'StatusData': ('dateTime', 'data'),
+}
+CAMPOS_FECHA = {'start', 'stop', 'dateTime'}
+CAMPOS_DURACION = {'drivingDuration'}
+
+
+def dia_cerrado(fecha_inicio):
+    """True si el día que empieza en fecha_inicio (UTC) ya no puede recibir datos"""
+    if fecha_inicio.tzinfo is None:
+        fecha_inicio = fecha_inicio.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) >= fecha_inicio + timedelta(days=1) + MARGEN_CIERRE
+
+
+def _a_json(campo, valor):
+    if valor is None:
+        return None
+    if campo in CAMPOS_FECHA and isinstance(valor, datetime):
+        return valor.isoformat()
+    if campo in CAMPOS_DURACION and isinstance(valor, timedelta):
+        return valor.total_seconds()
+    return valor
+
+
+def _desde_json(campo, valor):
+    if valor is None:
+        return None
+    if campo in CAMPOS_FECHA:
+        return datetime.fromisoformat(valor)
+    # Las duraciones llegan de Geotab como texto ("00:12:30") o como timedelta
+    if campo in CAMPOS_DURACION and isinstance(valor, (int, float)):
+        return timedelta(seconds=valor)
+    return valor
+
+
+def serializar(tipo, registros):
+    """Convierte entidades de Geotab a filas compactas para JSONB"""
+    campos = CAMPOS[tipo]
+    return [[_a_json(c, r.get(c)) for c in campos] for r in registros]
+
+
+def deserializar(tipo, filas):
+    """Reconstruye entidades con la misma forma que retorna mygeotab"""
+    campos = CAMPOS[tipo]
+    return [{c: _desde_json(c, v) for c, v in zip(campos, fila)} for fila in filas]
+
+
+def obtener_dia(device_id, fecha_inicio, tipos, consultar):
+    """
+    Retorna {tipo: registros} de un dispositivo en el día que empieza en fecha_inicio.
+    consultar(tipos) descarga de Geotab los tipos pedidos y retorna {tipo: registros}.
+    """
+    if not dia_cerrado(fecha_inicio):
+        return consultar(tipos)
+
+    fecha = fecha_inicio.date()
+    try:
+        guardados = leer_historial_dia(device_id, fecha, tipos)
+    except Exception as e:
+        print(f"Error leyendo historial local: {e}")
+        return consultar(tipos)
+
+    resultado = {tipo: deserializar(tipo, filas) for tipo, filas in guardados.items()}
+    faltantes = [t for t in tipos if t not in resultado]
+    if not faltantes:
+        return resultado
+
+    descargados = consultar(faltantes)
+    for tipo, registros in descargados.items():
+        try:
+            guardar_historial_dia(device_id, fecha, tipo, serializar(tipo, registros))
+        except Exception as e:
+            print(f"Error guardando historial local ({tipo}): {e}")
+        resultado[tipo] = registros
+
+    return resultado
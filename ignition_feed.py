@@ -0,0 +1,81 @@
+"""
+Estado de ignición por dispositivo usando GetFeed de Geotab
+- La primera consulta trae las últimas 24 horas de DiagnosticIgnitionId
+- Las siguientes solo traen los registros nuevos desde el último toVersion
+"""
+import threading
+from datetime import datetime, timedelta, timezone
+import mygeotab
+
+# Registros máximos por página de GetFeed (límite de Geotab: 50.000)
+FEED_RESULTS_LIMIT = 50000
+VENTANA_INICIAL = timedelta(days=1)
+
+
+def is_ignition_on(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value == 1
+    return str(value).strip().lower() in ('1', 'true', 'on', 'yes', 'encendido')
+
+
+class IgnitionFeed:
+    def __init__(self, llamar_geotab, results_limit=FEED_RESULTS_LIMIT):
+        """llamar_geotab: función con la firma de call_geotab(method, *args, **kwargs)"""
+        self.llamar_geotab = llamar_geotab
+        self.results_limit = results_limit
+        self.version = None
+        self.estado = {}  # device_id -> {'dateTime', 'motor_encendido'}
+        self._lock = threading.RLock()
+
+    def aplicar(self, registros):
+        """Aplica registros StatusData conservando el más reciente por dispositivo"""
+        for sd in registros:
+            device_raw = sd.get('device', {})
+            device_id = device_raw.get('id') if isinstance(device_raw, dict) else device_raw
+            dt = sd.get('dateTime')
+            if not device_id or not dt:
+                continue
+            actual = self.estado.get(device_id)
+            if actual is None or dt > actual['dateTime']:
+                self.estado[device_id] = {
+                    'dateTime': dt,
+                    'motor_encendido': is_ignition_on(sd.get('data'))
+                }
+
+    def llamada(self):
+        """Llamada GetFeed pendiente como (método, params), apta para ExecuteMultiCall"""
+        search = {'diagnosticSearch': {'id': 'DiagnosticIgnitionId'}}
+        if self.version is None:
+            search['fromDate'] = datetime.now(timezone.utc) - VENTANA_INICIAL
+        return ('GetFeed', {
+            'typeName': 'StatusData',
+            'search': search,
+            'fromVersion': self.version,
+            'resultsLimit': self.results_limit
+        })
+
+    def aplicar_pagina(self, resultado):
+        """Aplica una página de GetFeed; retorna True si quedan más páginas"""
+        with self._lock:
+            datos = resultado.get('data', [])
+            self.aplicar(datos)
+            self.version = resultado.get('toVersion')
+            # Página incompleta: ya estamos al día
+            return len(datos) >= self.results_limit
+
+    def actualizar(self):
+        """Trae los cambios pendientes del feed y retorna una copia del estado"""
+        with self._lock:
+            try:
+                while True:
+                    metodo, params = self.llamada()
+                    if not self.aplicar_pagina(self.llamar_geotab('call', metodo, **params)):
+                        break
+            except mygeotab.exceptions.MyGeotabException:
+                # Versión inválida o expirada: la próxima consulta vuelve a sembrar el estado
+                self.version = None
+                raise
+
+            return dict(self.estado)
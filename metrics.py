@@ -0,0 +1,111 @@
+"""
+Métricas Prometheus del consumo de la API de Geotab
+- Llamadas, latencia, entidades recibidas y re-autenticaciones
+- Etiqueta `origen`: ruta Flask, fase de SyncService o tarea en segundo plano
+- Se exponen en la ruta /metrics de app.py
+- Acumulador de tiempo por fase (geotab, db, ...) del request en curso, para Server-Timing
+- Latencia y filas por consulta SQL (huella normalizada), alimentadas por database.get_db_cursor
+"""
+import threading
+import time
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+GEOTAB_LLAMADAS = Counter(
+    'geotab_llamadas_total', 'Llamadas a la API de Geotab',
+    ['origen', 'metodo', 'entidad', 'resultado']
+)
+GEOTAB_LATENCIA = Histogram(
+    'geotab_latencia_segundos', 'Duración de las llamadas a la API de Geotab',
+    ['origen', 'metodo', 'entidad'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+GEOTAB_ENTIDADES = Counter(
+    'geotab_entidades_total', 'Entidades recibidas de la API de Geotab',
+    ['origen', 'metodo', 'entidad']
+)
+GEOTAB_REAUTENTICACIONES = Counter(
+    'geotab_reautenticaciones_total', 'Re-autenticaciones por token expirado',
+    ['origen']
+)
+DB_CONSULTAS = Histogram(
+    'db_consulta_segundos', 'Duración de las sentencias SQL por huella de consulta',
+    ['consulta'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+DB_FILAS = Counter(
+    'db_filas_total', 'Filas leídas o escritas por huella de consulta',
+    ['consulta']
+)
+DB_CONSULTAS_LENTAS = Counter(
+    'db_consultas_lentas_total', 'Sentencias SQL por encima del umbral de consulta lenta',
+    ['consulta']
+)
+
+
+# Tiempos por fase del request en curso (None si el request no se está midiendo)
+_fases = threading.local()
+
+
+def iniciar_fases():
+    """Empieza a acumular tiempos por fase en el hilo actual"""
+    _fases.tiempos = {}
+
+
+def terminar_fases():
+    """Deja de acumular y retorna {fase: segundos}"""
+    tiempos = getattr(_fases, 'tiempos', None)
+    _fases.tiempos = None
+    return tiempos or {}
+
+
+def registrar_fase(fase, segundos):
+    """Suma tiempo a una fase si el hilo actual se está midiendo"""
+    tiempos = getattr(_fases, 'tiempos', None)
+    if tiempos is not None:
+        tiempos[fase] = tiempos.get(fase, 0.0) + segundos
+
+
+def contar_entidades(resultado, metodo=None):
+    """Número de entidades en un resultado de Get, GetFeed o ExecuteMultiCall"""
+    if metodo == 'multi_call' and isinstance(resultado, list):
+        # Un resultado por llamada: lista de entidades (Get) o página de GetFeed
+        return sum(contar_entidades(r) for r in resultado)
+    if isinstance(resultado, list):
+        return len(resultado)
+    if isinstance(resultado, dict) and isinstance(resultado.get('data'), list):
+        return len(resultado['data'])
+    return 0
+
+
+def entidad_de(metodo, args, kwargs):
+    """Tipo de entidad de una llamada de mygeotab (get/call/multi_call)"""
+    if metodo == 'get' and args:
+        return args[0]
+    if metodo == 'call':
+        return kwargs.get('type_name') or kwargs.get('typeName') or (args[0] if args else '')
+    if metodo == 'multi_call' and args:
+        return '+'.join(p.get('typeName', m) for m, p in args[0])
+    return ''
+
+
+def medir_geotab(origen, metodo, entidad, llamar):
+    """Ejecuta llamar() registrando conteo, latencia y tamaño del resultado"""
+    inicio = time.perf_counter()
+    try:
+        resultado = llamar()
+    except Exception:
+        GEOTAB_LLAMADAS.labels(origen, metodo, entidad, 'error').inc()
+        raise
+    finally:
+        duracion = time.perf_counter() - inicio
+        GEOTAB_LATENCIA.labels(origen, metodo, entidad).observe(duracion)
+        registrar_fase('geotab', duracion)
+
+    GEOTAB_LLAMADAS.labels(origen, metodo, entidad, 'ok').inc()
+    GEOTAB_ENTIDADES.labels(origen, metodo, entidad).inc(contar_entidades(resultado, metodo))
+    return resultado
+
+
+def exportar_metricas():
+    """Retorna (cuerpo, content_type) en formato de texto de Prometheus"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,99 @@
+"""
+Armado del recorrido de un día: puntos GPS agrupados por viaje
+- Los LogRecord se ordenan una vez y cada viaje toma su rango por búsqueda binaria
+- La ignición de cada punto es el último StatusData anterior o igual al punto (as-of)
+- Simplificación opcional del trazado según tolerancia en metros o zoom del mapa
+"""
+from bisect import bisect_left, bisect_right
+from ignition_feed import is_ignition_on
+from geo_utils import simplificar
+
+
+def indice_ignicion(status_data):
+    """Retorna (tiempos, estados) de ignición ordenados por fecha"""
+    registros = sorted(
+        ((sd.get('dateTime'), is_ignition_on(sd.get('data', 0))) for sd in status_data if sd.get('dateTime')),
+        key=lambda x: x[0]
+    )
+    return [r[0] for r in registros], [r[1] for r in registros]
+
+
+def ignicion_en(tiempos, estados, fecha):
+    """Estado de ignición vigente en `fecha`, o None si no hay registro previo"""
+    i = bisect_right(tiempos, fecha) - 1
+    return estados[i] if i >= 0 else None
+
+
+def agrupar_por_viaje(trips, log_records, status_data):
+    """Agrupa los puntos GPS por viaje con su estado de ignición"""
+    registros = sorted((r for r in log_records if r.get('dateTime')), key=lambda r: r['dateTime'])
+    tiempos = [r['dateTime'] for r in registros]
+    ign_tiempos, ign_estados = indice_ignicion(status_data)
+
+    viajes_con_puntos = []
+    punto_global = 0  # Contador global de puntos
+
+    for i, trip in enumerate(trips):
+        trip_start = trip.get('start')
+        trip_stop = trip.get('stop')
+        if not trip_start or not trip_stop:
+            continue
+
+        puntos_viaje = []
+        # Rango [inicio, fin] del viaje dentro de los registros ordenados
+        desde = bisect_left(tiempos, trip_start)
+        hasta = bisect_right(tiempos, trip_stop)
+        for record in registros[desde:hasta]:
+            lat = record.get('latitude', 0)
+            lng = record.get('longitude', 0)
+            velocidad = record.get('speed', 0) or 0
+            if lat and lng and lat != 0 and lng != 0:
+                punto_global += 1
+                record_time = record['dateTime']
+
+                ignicion = ignicion_en(ign_tiempos, ign_estados, record_time)
+                # Si no hay datos de ignición, usar velocidad como indicador
+                if ignicion is None:
+                    ignicion = velocidad > 0
+
+                puntos_viaje.append({
+                    'num': punto_global,
+                    'lat': lat,
+                    'lng': lng,
+                    'velocidad': velocidad,
+                    'fecha': str(record_time),
+                    'ignicion': ignicion
+                })
+
+        if puntos_viaje:
+            viajes_con_puntos.append({
+                'viaje_num': i + 1,
+                'inicio': str(trip_start),
+                'fin': str(trip_stop),
+                'fin_lat': trip.get('stopLatitude', 0) or 0,
+                'fin_lng': trip.get('stopLongitude', 0) or 0,
+                'puntos': puntos_viaje,
+                'total_puntos': len(puntos_viaje)
+            })
+
+    return viajes_con_puntos
+
+
+def simplificar_viajes(viajes, tolerancia_m, limite_velocidad):
+    """
+    Simplifica los puntos de cada viaje (Douglas-Peucker) en el mismo lugar.
+    Se conservan inicio/fin, cambios de ignición y excesos de velocidad.
+    """
+    for viaje in viajes:
+        puntos = viaje['puntos']
+        obligatorios = [
+            i for i, p in enumerate(puntos)
+            if p['velocidad'] > limite_velocidad or (i > 0 and p['ignicion'] != puntos[i - 1]['ignicion'])
+        ]
+        indices = simplificar([(p['lat'], p['lng']) for p in puntos], tolerancia_m, obligatorios)
+
+        viaje['total_puntos_original'] = len(puntos)
+        viaje['puntos'] = [puntos[i] for i in indices]
+        viaje['total_puntos'] = len(viaje['puntos'])
+
+    return viajes
@@ -13,16 +13,22 @@ import os
 
 # Importar módulo de base de datos
 from database import (
-    get_connection, get_db_cursor, guardar_ubicacion, guardar_viaje,
-    guardar_reporte_gps, guardar_exceso_velocidad,
-    actualizar_resumen_diario, log_sync, init_database
+    get_db_cursor, guardar_ubicaciones, guardar_viajes,
+    guardar_reportes_gps, guardar_excesos_velocidad,
+    actualizar_resumenes_diarios, log_sync, init_database,
+    cargar_reportes_gps, mantener_particiones
 )
+from device_index import device_index
+from ignition_feed import FEED_RESULTS_LIMIT
+from metrics import medir_geotab, GEOTAB_REAUTENTICACIONES
 
 load_dotenv()
 
 # Configuración
 SYNC_INTERVAL = 300  # 5 minutos en segundos
 LIMITE_VELOCIDAD = 80  # km/h para excesos
+# Guardar todos los puntos GPS (LogRecord) en reportes_gps, no solo inicio y fin de viajes
+SYNC_PUNTOS_GPS = os.getenv('SYNC_PUNTOS_GPS', '0') == '1'
 COLOMBIA_TZ = ZoneInfo('America/Bogota')
 
 
@@ -40,12 +46,25 @@ def to_colombia_datetime(value):
         dt = dt.replace(tzinfo=timezone.utc)
     return dt.astimezone(COLOMBIA_TZ).replace(tzinfo=None)
 
+
+def fecha_y_hora_utc(value):
+    """(día en Colombia, hora UTC sin zona) de un instante de Geotab: la llave de reportes_gps y excesos"""
+    if not value:
+        return None, None
+    dt = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(COLOMBIA_TZ).date(), dt.astimezone(timezone.utc).replace(tzinfo=None)
+
 class SyncService:
     def __init__(self):
         self.api = None
         self.running = False
         self.thread = None
         self.ultima_sync = None
+        self.version_puntos = None  # toVersion del feed de LogRecord
+        self.fecha_resumen_completo = None  # último día con resumen recalculado para toda la flota
+        self.fecha_mantenimiento = None  # último día en que se revisaron particiones y retención
         self.conectar()
 
     def conectar(self):
@@ -63,32 +82,49 @@ class SyncService:
             print(f"âŒ Error conectando a Geotab: {e}")
             return False
 
+    def _llamar_geotab(self, fase, metodo, tipo, llamar):
+        """Ejecuta llamar() con métricas por fase de sync; reconecta una vez si el token expiró"""
+        try:
+            return medir_geotab(fase, metodo, tipo, llamar)
+        except mygeotab.exceptions.AuthenticationException:
+            GEOTAB_REAUTENTICACIONES.labels(fase).inc()
+            self.conectar()
+            return medir_geotab(fase, metodo, tipo, llamar)
+
+    def get_geotab(self, fase, tipo, **params):
+        """self.api.get con métricas por fase de sync"""
+        return self._llamar_geotab(fase, 'get', tipo, lambda: self.api.get(tipo, **params))
+
+    def feed_geotab(self, fase, tipo, search, from_version):
+        """Una página de GetFeed con métricas por fase de sync"""
+        return self._llamar_geotab(fase, 'call', tipo, lambda: self.api.call(
+            'GetFeed', typeName=tipo, search=search,
+            fromVersion=from_version, resultsLimit=FEED_RESULTS_LIMIT
+        ))
+
     def sync_dispositivos(self):
         """Sincroniza lista de dispositivos"""
-        conn = None
         try:
-            devices = self.api.get('Device')
-            conn = get_connection()
-            cursor = conn.cursor()
-
-            for device in devices:
-                cursor.execute('''
-                    INSERT INTO dispositivos (id, placa, serial_number, tipo_dispositivo, activo)
-                    VALUES (%s, %s, %s, %s, 1)
-                    ON CONFLICT (id) DO UPDATE SET
-                        placa = EXCLUDED.placa,
-                        serial_number = EXCLUDED.serial_number,
-                        tipo_dispositivo = EXCLUDED.tipo_dispositivo,
-                        activo = EXCLUDED.activo
-                ''', (
-                    device.get('id'),
-                    device.get('name'),
-                    device.get('serialNumber', ''),
-                    device.get('deviceType', '')
-                ))
-
-            conn.commit()
-            cursor.close()
+            devices = self.get_geotab('sync_dispositivos', 'Device')
+            with get_db_cursor() as cursor:
+                for device in devices:
+                    cursor.execute('''
+                        INSERT INTO dispositivos (id, placa, serial_number, tipo_dispositivo, activo)
+                        VALUES (%s, %s, %s, %s, 1)
+                        ON CONFLICT (id) DO UPDATE SET
+                            placa = EXCLUDED.placa,
+                            serial_number = EXCLUDED.serial_number,
+                            tipo_dispositivo = EXCLUDED.tipo_dispositivo,
+                            activo = EXCLUDED.activo
+                    ''', (
+                        device.get('id'),
+                        device.get('name'),
+                        device.get('serialNumber', ''),
+                        device.get('deviceType', '')
+                    ))
+
+            # Compartir la lista recién descargada con el índice de las rutas web
+            device_index.actualizar(devices)
 
             log_sync('dispositivos', len(devices))
             print(f"✅ Sincronizados {len(devices)} dispositivos")
@@ -97,21 +133,23 @@ class SyncService:
             log_sync('dispositivos', 0, 'ERROR', str(e))
             print(f"âŒ Error sincronizando dispositivos: {e}")
             return 0
-        finally:
-            if conn:
-                conn.close()
 
     def sync_ubicaciones(self):
         """Sincroniza ubicaciones actuales de todos los vehículos"""
         try:
-            device_statuses = self.api.get('DeviceStatusInfo')
-            count = 0
+            device_statuses = self.get_geotab('sync_ubicaciones', 'DeviceStatusInfo')
+            filas = []
 
             for status in device_statuses:
                 try:
                     device = status.get('device', {})
                     device_id = device.get('id') if isinstance(device, dict) else device
-                    placa = device.get('name', str(device_id)) if isinstance(device, dict) else str(device_id)
+                    # DeviceStatusInfo solo trae el id; la placa sale del índice de dispositivos
+                    info = device_index.por_id(device_id)
+                    if info:
+                        placa = info['placa']
+                    else:
+                        placa = device.get('name', str(device_id)) if isinstance(device, dict) else str(device_id)
 
                     lat = status.get('latitude', 0)
                     lng = status.get('longitude', 0)
@@ -120,13 +158,13 @@ class SyncService:
                     fecha_gps = to_colombia_datetime(status.get('dateTime'))
                     comunicando = 1 if status.get('isDeviceCommunicating', False) else 0
 
-                    guardar_ubicacion(
-                        device_id, placa, lat, lng, velocidad, direccion, fecha_gps, comunicando
-                    )
-                    count += 1
+                    filas.append((device_id, placa, lat, lng, velocidad, direccion, fecha_gps, comunicando))
                 except Exception as e:
                     continue
 
+            # Toda la flota en un solo viaje a la base de datos
+            count = guardar_ubicaciones(filas)
+
             log_sync('ubicaciones', count)
             print(f"✅ Sincronizadas {count} ubicaciones")
             return count
@@ -156,15 +194,17 @@ class SyncService:
             from_date = datetime.combine(fecha, datetime.min.time())
             to_date = datetime.combine(fecha, datetime.max.time())
 
-            total_viajes = 0
-            total_excesos = 0
+            # Se acumulan las filas de toda la flota y se escriben en lote al final
+            viajes = []
+            reportes = []
+            excesos = []
 
             for disp in dispositivos:
                 try:
-                    trips = self.api.get('Trip',
-                                        deviceSearch={'id': disp['id']},
-                                        fromDate=from_date,
-                                        toDate=to_date)
+                    trips = self.get_geotab('sync_viajes', 'Trip',
+                                            deviceSearch={'id': disp['id']},
+                                            fromDate=from_date,
+                                            toDate=to_date)
 
                     for i, trip in enumerate(trips, 1):
                         # Obtener datos del viaje (usando .get() para diccionarios)
@@ -191,40 +231,52 @@ class SyncService:
                         lat_fin = trip.get('stopLatitude') or 0
                         lng_fin = trip.get('stopLongitude') or 0
 
-                        # Guardar viaje
-                        guardar_viaje(
+                        viajes.append((
                             disp['id'], disp['placa'], str(fecha), i,
                             start_time, stop_time, distance, duracion, vel_max,
                             lat_ini, lng_ini, lat_fin, lng_fin
-                        )
-                        total_viajes += 1
-
-                        # Guardar puntos GPS del viaje en reportes_gps
-                        # (inicio y fin) para que total_reportes no sea 0
-                        if lat_ini and lng_ini:
-                            guardar_reporte_gps(
-                                disp['id'], disp['placa'], str(fecha),
-                                lat_ini, lng_ini, 0, start_time, True
-                            )
-                        if lat_fin and lng_fin:
-                            guardar_reporte_gps(
-                                disp['id'], disp['placa'], str(fecha),
-                                lat_fin, lng_fin, 0, stop_time, False
-                            )
+                        ))
+
+                        # Puntos GPS del viaje en reportes_gps
+                        # (inicio y fin) para que total_reportes no sea 0.
+                        # Misma llave que sync_puntos_gps: día en Colombia y hora UTC
+                        dia_ini, utc_ini = fecha_y_hora_utc(start_time)
+                        dia_fin, utc_fin = fecha_y_hora_utc(stop_time)
+                        if lat_ini and lng_ini and utc_ini:
+                            reportes.append((disp['id'], disp['placa'], dia_ini,
+                                             lat_ini, lng_ini, 0, utc_ini, True))
+                        if lat_fin and lng_fin and utc_fin:
+                            reportes.append((disp['id'], disp['placa'], dia_fin,
+                                             lat_fin, lng_fin, 0, utc_fin, False))
 
                         # Detectar exceso de velocidad basado en velocidad máxima del viaje
-                        if vel_max > LIMITE_VELOCIDAD:
-                            guardar_exceso_velocidad(
-                                disp['id'], disp['placa'], str(fecha),
-                                vel_max, 0, 0, start_time, LIMITE_VELOCIDAD
-                            )
-                            total_excesos += 1
+                        if vel_max > LIMITE_VELOCIDAD and utc_ini:
+                            excesos.append((disp['id'], disp['placa'], dia_ini,
+                                            vel_max, 0, 0, utc_ini, LIMITE_VELOCIDAD))
 
                 except Exception as e:
                     continue
 
-                # Actualizar resumen diario del vehículo
-                actualizar_resumen_diario(disp['placa'], str(fecha))
+            cambiadas = guardar_viajes(viajes)
+            guardar_reportes_gps(reportes)
+            guardar_excesos_velocidad(excesos)
+            total_viajes = len(viajes)
+            total_excesos = len(excesos)
+
+            # Resumen diario: la primera vez en el día para toda la flota (incluye vehículos
+            # sin viajes), después solo para las placas cuyos viajes cambiaron
+            if self.fecha_resumen_completo != fecha:
+                actualizar_resumenes_diarios(str(fecha))
+                self.fecha_resumen_completo = fecha
+            else:
+                actualizar_resumenes_diarios(str(fecha), cambiadas)
+            # Puntos de viajes que caen en otro día en Colombia (viajes cerca de medianoche)
+            otros_dias = {}
+            for fila in reportes + excesos:
+                if fila[2] != fecha:
+                    otros_dias.setdefault(fila[2], set()).add(fila[1])
+            for dia, placas in otros_dias.items():
+                actualizar_resumenes_diarios(dia, placas)
 
             log_sync('viajes', total_viajes)
             print(f"✅ Sincronizados {total_viajes} viajes, {total_excesos} excesos de velocidad")
@@ -235,6 +287,58 @@ class SyncService:
             print(f"âŒ Error sincronizando viajes: {e}")
             return 0
 
+    def sync_puntos_gps(self):
+        """Descarga los LogRecord nuevos de toda la flota (GetFeed) y los carga con COPY en reportes_gps"""
+        try:
+            total = 0
+            while True:
+                search = {}
+                if self.version_puntos is None:
+                    # Primera consulta: desde la medianoche de hoy en Colombia
+                    inicio_dia = datetime.now(COLOMBIA_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+                    search['fromDate'] = inicio_dia.astimezone(timezone.utc)
+
+                try:
+                    pagina = self.feed_geotab('sync_puntos_gps', 'LogRecord', search, self.version_puntos)
+                except mygeotab.exceptions.MyGeotabException:
+                    # Versión inválida o expirada: la próxima vez se vuelve a sembrar desde hoy
+                    self.version_puntos = None
+                    raise
+
+                filas = []
+                for record in pagina.get('data', []):
+                    device = record.get('device', {})
+                    device_id = device.get('id') if isinstance(device, dict) else device
+                    info = device_index.por_id(device_id)
+                    dt = record.get('dateTime')
+                    if not info or not dt:
+                        continue  # dispositivos desconocidos romperían la llave foránea
+                    dia, hora_utc = fecha_y_hora_utc(dt)
+                    filas.append((
+                        device_id, info['placa'], dia,
+                        record.get('latitude'), record.get('longitude'), record.get('speed', 0),
+                        hora_utc, None
+                    ))
+
+                total += cargar_reportes_gps(filas)
+                # total_reportes cambia para los vehículos con puntos nuevos
+                por_fecha = {}
+                for fila in filas:
+                    por_fecha.setdefault(fila[2], set()).add(fila[1])
+                for fecha, placas in por_fecha.items():
+                    actualizar_resumenes_diarios(fecha, placas)
+                self.version_puntos = pagina.get('toVersion')
+                if len(pagina.get('data', [])) < FEED_RESULTS_LIMIT:
+                    break
+
+            log_sync('puntos_gps', total)
+            print(f"✅ Sincronizados {total} puntos GPS")
+            return total
+        except Exception as e:
+            log_sync('puntos_gps', 0, 'ERROR', str(e))
+            print(f"âŒ Error sincronizando puntos GPS: {e}")
+            return 0
+
     def ejecutar_sync_completa(self):
         """Ejecuta sincronización completa"""
         print(f"\nðŸ”„ Iniciando sincronización - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -252,6 +356,18 @@ class SyncService:
         # Sincronizar viajes del día actual
         self.sync_viajes_dia()
 
+        # Puntos GPS completos (opcional: volumen alto)
+        if SYNC_PUNTOS_GPS:
+            self.sync_puntos_gps()
+
+        # Particiones de los próximos meses y retención, una vez al día
+        if self.fecha_mantenimiento != datetime.now().date():
+            try:
+                mantener_particiones()
+                self.fecha_mantenimiento = datetime.now().date()
+            except Exception as e:
+                print(f"Error en mantenimiento de particiones: {e}")
+
         self.ultima_sync = datetime.now()
         print(f"✅ Sincronización completa - {self.ultima_sync.strftime('%Y-%m-%d %H:%M:%S')}\n")
 